@@ -88,11 +88,55 @@
 #                         later on. Strange.
 # 2014-01-07, V1.6.5 jw - manually merged https://github.com/jnweiger/pdfcompare/pull/4
 #                         hope, I did not break too much...
+# 2026-10-18, V1.7  jw - anchored_opcodes() splits the documents at unique common 
+#                        words (patience diff) and runs SequenceMatcher only in the gaps.
+#                      - new option --diff-algorithm: difflib, myers, patience, histogram.
+#                      - intern_wordlist(): the diff runs on arrays of word numbers.
+#                      - moved_block_pairs(): opcodes_find_moved() is no longer quadratic,
+#                        blocks are indexed by their rarest words.
+#                      - new option --jobs: second level diffs run in a process pool.
+#                      - new option --segment-words: segmented_opcodes() splits the word diff
+#                        into segments, which are diffed in parallel with --jobs.
+#                      - new option --max-diff-cost: coarse_opcodes() marks entire lines
+#                        or pages, if the word diff would be too expensive.
+#                      - new option --line-diff: line_word_opcodes() diffs lines first, 
+#                        then words inside the changed lines only.
+#                      - new option --cache-dir: extracted wordlists of OLDFILE are cached.
+#                        The resulting marks are also cached, keyed by both input files.
+#                      - INFILE and OLDFILE are extracted concurrently.
+#                      - pdf2xml_sharded(): with --jobs, pdftohtml runs on page ranges in parallel.
+#                      - xml_pages(): pdftohtml output is parsed while it arrives, into 
+#                        PdfPage objects. No dom tree is kept, but the PdfPage list still
+#                        holds the whole document, as it is walked several times.
+#                      - class TextRun: each <text> is converted once, and is the context 
+#                        of its words. Search uses its letter spacing zapped text.
+#                      - pdftohtml runs only once: its output is always parsed through
+#                        AnchorFilter, no retry needed.
+#                      - class WordList: words are three numbers in arrays, referring to
+#                        line texts and contexts stored once per line.
+#                      - page2wordlist() replaces textline2wordlist(), it finds the words
+#                        of an entire page with one regexp.
+#                      - bbox_run_class(), bbox_words(): margins are applied to entire runs,
+#                        only runs crossing the border are checked word by word.
+#                      - new option --extractor: pypdf2pages() reads the text runs directly
+#                        from the page contents, as an alternative to pdftohtml.
+#                      - -F and -L fixed: pages are selected by their page number, not by
+#                        position. pdf_page() loads only the pages in range.
+#                      - xml2fontinfo() returns one font table per document, fonts are
+#                        loaded through cached_font(), an LRU cache shared by all documents.
+#                      - rendered_text_pos() uses cached glyph advances and prefix widths
+#                        per text, instead of three font.metrics() calls per mark.
+#                      - fonts are loaded lazily, when the first mark needs them.
+#                        PGF.init() is deferred to cached_font().
+#                      - new option --font-metrics: reportlab_font() measures characters without
+#                        pygame. pygame is imported on first use only, and is optional.
+#                      - -s compiles the pattern once, and searches the text of each page
+#                        in one pass. Matches may span several text runs.
 #
 # osc in devel:languages:python python-pypdf >= 1.13+20130112
 #  need fix from https://bugs.launchpad.net/pypdf/+bug/242756
 # osc in devel:languages:python python-reportlab
-# osc in devel:languages:python python-pygame
+# osc in devel:languages:python python-pygame (optional, see --font-metrics)
 # osc in X11:common:Factory poppler-tools 
 #
 # needs module difflib from python-base
@@ -115,7 +159,7 @@ from __future__ import with_statement
 from __future__ import print_function
 # from __future__ import division
 
-__VERSION__ = '1.6.5'
+__VERSION__ = '1.7'
 
 try:
   # python2
@@ -123,18 +167,27 @@ try:
 except ImportError:
   # python3, breaks python2-reportlab
   from io import StringIO
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
 from pyPdf import PdfFileWriter, PdfFileReader, generic as Pdf
+from pyPdf.pdf import ContentStream, PageObject
 from reportlab.pdfgen import canvas
 from reportlab.lib.colors import Color
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont, TTFError
 import urllib   # used when normal encode fails.
 
-import re, time
+import re, time, bisect, math, hashlib, zlib, binascii
 from pprint import pprint
 import xml.etree.cElementTree as ET
 import sys, os, subprocess
+import multiprocessing, threading
 from argparse import ArgumentParser
-import pygame.font as PGF
 from difflib import SequenceMatcher
+from array import array
+from collections import OrderedDict
 # FIXME: class Hunspell should be loaded as a module
 # import HunspellPure
 
@@ -412,27 +465,224 @@ def page_watermark(canv, box, argv, color=[1,0,1], trans=0.5, p_w=None, p_h=None
 #     super(RelaxedXMLParser,self).feed(data)
 
 
-def pdf2xml(parser, infile, key='', firstpage=None, lastpage=None):
-  """ read a pdf file with pdftohtml and parse the resulting xml into a dom tree
+class AnchorFilter(object):
+  """ a file object reading from source, with all <a ...> and </a> tags removed.
+      pdftohtml -xml misplaces them:
+      <i>Scanning Issue<a href="http://support.novell.com/">s</i>and</a>
+      Unlike with RelaxedXMLParser above, a tag crossing the border of a read
+      is not missed: an unterminated tag at the end is held back for the next read.
+  """
+  re_anchor = re.compile("(<a.*?>|</a>)")
+
+  def __init__(self, source):
+    self.source = source
+    self.rest = ''
+
+  def read(self, size=-1):
+    while True:
+      more = self.source.read(size)
+      data = self.rest + more
+      self.rest = ''
+      if len(more):
+        i = data.rfind('<')
+        if i >= 0 and data.find('>', i) < 0:
+          data, self.rest = data[:i], data[i:]
+      data = self.re_anchor.sub('', data)
+      if len(data) or not len(more):
+        return data
+
+class BackgroundCall(threading.Thread):
+  """ calls func(*args, **kw) in a separate thread. result() waits for it,
+      and returns the return value, or raises the same exception in the
+      calling thread. This includes SystemExit from parser.exit().
+  """
+  def __init__(self, func, *args, **kw):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.func = func
+    self.args = args
+    self.kw = kw
+    self.value = None
+    self.exc = None
+    self.start()
+
+  def run(self):
+    try:
+      self.value = self.func(*self.args, **self.kw)
+    except BaseException as e:
+      self.exc = e
+
+  def result(self):
+    self.join()
+    if self.exc is not None:
+      raise self.exc
+    return self.value
+
+class TextRun(dict):
+  """ one <text> element of a page. As a dict, it is the shared context of
+      all words of the run, see DecoratedWord: x, y, w, h is the bounding box
+      as floats, f the font id, l the crude location t, c, b on the page,
+      and p is added by xml2wordlist(). text is the text as found, 
+      norm is the text after zap_letter_spacing(), computed on first use.
+  """
+  __slots__ = ('text', '_norm')
+
+  def __init__(self, text, x, y, w, h, f, p_h):
+    ## crude top,center,bottom location
+    if   y > 0.66*p_h: l = 'b'
+    elif y > 0.33*p_h: l = 'c'
+    else:              l = 't'
+    dict.__init__(self, l=l, x=x, y=y, w=w, h=h, f=f)
+    self.text = text
+    self._norm = None
+
+  @property
+  def norm(self):
+    if self._norm is None:
+      self._norm = zap_letter_spacing(self.text)
+    return self._norm
+
+class PdfPage(object):
+  """ all we need to know about one page, as e.g. a <page> element of pdftohtml -xml:
+      nr is the page number, x, y, w, h the page box as floats,
+      fonts a list of fontspec attribute dicts, and texts a list of
+      TextRun objects, one per <text> element.
+      Diff, search, spell check and marks all work on these.
+      The extractors produce them, see xml_page(), pypdf2pages().
+  """
+  __slots__ = ('nr', 'x', 'y', 'w', 'h', 'fonts', 'texts')
+
+  def __init__(self, nr, x, y, w, h):
+    self.nr = nr
+    self.x = x
+    self.y = y
+    self.w = w
+    self.h = h
+    self.fonts = []
+    self.texts = []
+
+def xml_page(elem):
+  """ converts a <page> element of pdftohtml -xml into a PdfPage. """
+  p = PdfPage(int(elem.get('number')), float(elem.get('left')), float(elem.get('top')),
+              float(elem.get('width')), float(elem.get('height')))
+  p.fonts = [dict(f.attrib) for f in elem.findall('fontspec')]
+  # <text font="0" height="19" left="54" top="107" width="87"><b>Features</b></text>
+  p.texts = [TextRun(''.join(e.itertext()), float(e.get('left')), float(e.get('top')),
+                     float(e.get('width')), float(e.get('height')), e.get('font'), p.h)
+             for e in elem.findall('text')]
+  return p
+
+def xml_pages(source):
+  """ a generator parsing pdftohtml -xml output from the file object source.
+      Yields one PdfPage per <page>. Each <page> element is dropped right
+      after use, so that we never hold more than one page of xml in memory.
+      The PdfPage objects are much smaller than the xml, but callers that
+      keep them all, like do_pdf2xml(), still need memory per document.
+  """
+  root = None
+  for event, elem in ET.iterparse(source, events=('start', 'end')):
+    if root is None:
+      root = elem
+    elif event == 'end' and elem.tag == 'page':
+      yield xml_page(elem)
+      root.clear()
+
+def pages2xml(pages, fname):
+  """ writes a list of PdfPage objects as pdftohtml -xml would. Used for debugging. """
+  root = ET.Element('pdf2xml')
+  for p in pages:
+    pe = ET.SubElement(root, 'page', number=str(p.nr), position='absolute',
+                       top=str(p.y), left=str(p.x), height=str(p.h), width=str(p.w))
+    for fspec in p.fonts:
+      ET.SubElement(pe, 'fontspec', fspec)
+    for r in p.texts:
+      ET.SubElement(pe, 'text', top=str(r['y']), left=str(r['x']), width=str(r['w']),
+                    height=str(r['h']), font=r['f']).text = r.text
+  ET.ElementTree(root).write(fname, encoding='utf-8')
+
+def pdf2xml(parser, infile, key='', firstpage=None, lastpage=None, jobs=1):
+  """ read a pdf file with pdftohtml and parse the resulting xml into a list of PdfPage objects.
       the first parameter, parser is only used for calling exit() with proper messages.
+      With jobs > 1, long documents are split into page ranges, see pdf2xml_sharded().
 
-      FIXME: a fallback with a preprocessing xml parser (slower and more memory 
-      consuming, but irrelevant, considered the slowness of SequenceMatcher...)
-      is attemted, if the normal cElementTree parser fails.
+      do_pdf2xml() parses through a preprocessing filter, AnchorFilter.
       This compensates for a bug in pdftohtml -xml yielding invalid xml.
   """
-  dom = do_pdf2xml(parser, infile, key=key, firstpage=firstpage, lastpage=lastpage, relaxed=False)
-  if dom is None:
-    print(" pdf2xml retrying more relaxed ...")
-    dom = do_pdf2xml(parser, infile, key=key, firstpage=firstpage, lastpage=lastpage, relaxed=True)
-  return dom
-
-def do_pdf2xml(parser, infile, key='', firstpage=None, lastpage=None, relaxed=False):
-  """ read a pdf file with pdftohtml and parse the resulting xml into a dom tree
+  if jobs > 1:
+    pages = pdf2xml_sharded(parser, infile, key, firstpage, lastpage, jobs)
+    if pages is not None: return pages
+  return do_pdf2xml(parser, infile, key=key, firstpage=firstpage, lastpage=lastpage)
+
+def pdf_page_count(infile, key=''):
+  """ returns the number of pages as reported by pdfinfo, or None. """
+  cmd = ["pdfinfo"]
+  if len(key):
+    cmd += ["-upw", key]
+  try:
+    p = subprocess.Popen(cmd + [infile], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    out = p.communicate()[0].decode('utf-8', 'replace')
+  except OSError as e:
+    print("pdfinfo failed: " + str(e))
+    return None
+  m = re.search(r"^Pages:\s+(\d+)", out, re.M)
+  if m: return int(m.group(1))
+  return None
+
+def pdf2xml_sharded(parser, infile, key='', firstpage=None, lastpage=None, jobs=2, min_pages=20):
+  """ splits the page range into up to jobs shards of at least min_pages
+      pages, runs one pdftohtml per shard in parallel, and stitches the pages
+      back together into one list of pages, as if pdftohtml had done it all.
+      pdftohtml numbers its fontspec ids per run, these are renumbered to
+      be unique, and fonts already known from an earlier shard are not
+      repeated. Returns None, if the document is too short for sharding.
+  """
+  n = pdf_page_count(infile, key)
+  if n is None: return None
+  first = int(firstpage or 1)
+  last = min(int(lastpage or n), n)
+  shards = min(jobs, (last-first+1)//min_pages)
+  if shards < 2: return None
+  print("pdf2xml: %d shards of pages %d-%d" % (shards, first, last))
+
+  size = float(last-first+1)/shards
+  bounds = [first + int(round(k*size)) for k in range(shards)] + [last+1]
+  threads = [BackgroundCall(pdf2xml, parser, infile, key, str(bounds[k]), str(bounds[k+1]-1))
+             for k in range(shards)]
+  shards = [t.result() for t in threads]
+
+  pages = []
+  fonts = {}                    # (size, family, color) -> global id
+  for k, shard in enumerate(shards):
+    f_map = {}                  # local id -> global id
+    for p_nr, p in enumerate(shard):
+      p.nr = bounds[k] + p_nr
+      fspecs = []
+      for fspec in p.fonts:
+        f_key = (fspec.get('size'), fspec.get('family'), fspec.get('color'))
+        if not f_key in fonts:  # else known from an earlier page
+          fonts[f_key] = str(len(fonts))
+          fspecs.append(fspec)
+        f_map[fspec.get('id')] = fonts[f_key]
+        fspec['id'] = fonts[f_key]
+      p.fonts = fspecs
+    for p in shard:
+      for r in p.texts:
+        r['f'] = f_map.get(r['f'], r['f'])
+    pages += shard
+  return pages
+
+def do_pdf2xml(parser, infile, key='', firstpage=None, lastpage=None):
+  """ read a pdf file with pdftohtml and parse the resulting xml into a list of PdfPage objects.
+      The xml is parsed while pdftohtml writes it, see xml_pages(). Only the
+      dom tree is avoided: the returned list holds all pages, because
+      xml2wordlist(), xml2fontinfo() and pdfhtml_xml_find() each walk them.
       the first parameter, parser is only used for calling exit() with proper messages.
 
       CAUTION: this uses pdftohtml -xml, which may return invalid xml. A workaround
-      for some cases is provided, if relaxed=True.
+      for some cases is provided: The output is always parsed through AnchorFilter.
+      With valid xml this makes no difference, as the text inside <a> elements
+      is kept; misplaced <a> tags need no second pass. pdftohtml runs only once,
+      and its output is never copied.
   """
   pdftohtml_cmd = ["pdftohtml", "-q", "-i", "-nodrm", "-nomerge", "-stdout", "-xml"]
   if firstpage is not None:
@@ -442,26 +692,405 @@ def do_pdf2xml(parser, infile, key='', firstpage=None, lastpage=None, relaxed=Fa
   if len(key):
     pdftohtml_cmd += ["-upw", key]
   try:
-    (to_child, from_child) = os.popen2(pdftohtml_cmd + [infile])
+    # close_fds: with pdf2xml() running in two threads, one pdftohtml must not
+    # inherit the pipe of the other, or the other never sees EOF.
+    child = subprocess.Popen(pdftohtml_cmd + [infile], stdout=subprocess.PIPE, close_fds=True)
+    from_child = child.stdout
   except Exception as e:
     print(" ".join(pdftohtml_cmd + [infile]))
     parser.exit("pdftohtml -xml failed: " + " ".join(pdftohtml_cmd + [infile]) + ": " + str(e))
 
   try:
-    if relaxed:
-      data = from_child.read()
-      data = re.sub("(<a.*?>|</a>)","", data)      # <a...> </a> appear to be misplaced.
-      dom = ET.parse(StringIO(data))
+    try:
+      pages = list(xml_pages(AnchorFilter(from_child)))
+    except Exception as e:
+      print(" ".join(pdftohtml_cmd + [infile]))
+      parser.exit("pdftohtml -xml failed.\nET.iterparse: " + str(e) + ")\n\n" + parser.format_usage())
+  finally:
+    from_child.close()
+    child.wait()
+  print("pdf2xml done")
+  return pages
+
+def open_pdf(parser, fname, key='', memo={}):
+  """ returns a PdfFileReader for fname, decrypted with key if needed.
+      Each file is opened once per run, pypdf2pages() and main() share it.
+  """
+  if not fname in memo:
+    reader = PdfFileReader(file(fname, "rb"))
+    if reader.getIsEncrypted():
+      if reader.decrypt(key):
+        if len(key):
+          print("Decrypted using key='%s'." % key)
+      else:
+        parser.exit("decrypt(key='%s') failed." % key)
+    memo[fname] = reader
+  return memo[fname]
+
+def pdf_num_pages(reader):
+  """ the number of pages of reader, from the /Count of the page tree root.
+      Unlike reader.getNumPages(), no page object is loaded.
+  """
+  return int(reader.trailer['/Root']['/Pages']['/Count'])
+
+def pdf_page(reader, nr):
+  """ returns page nr (starting at 0) of reader, like reader.getPage(nr).
+      reader.getPage() flattens the entire page tree on first use; here we
+      descend only along the path to page nr, skipping other subtrees by
+      their /Count. So with -F and -L only the pages in range are loaded.
+      The inheritable attributes are copied into the page like pyPdf does.
+      The same PageObject is returned for repeated calls: the pages are
+      cached in the reader itself, and go away with it.
+  """
+  memo = getattr(reader, 'pdf_page_cache', None)
+  if memo is None: memo = reader.pdf_page_cache = {}
+  if nr in memo: return memo[nr]
+  if nr < 0 or nr >= pdf_num_pages(reader):
+    raise IndexError("page %d out of range" % nr)
+  inherit = {}
+  ref = None
+  node = reader.trailer['/Root']['/Pages']
+  idx = nr
+  while '/Kids' in node:
+    for attr in ('/Resources', '/MediaBox', '/CropBox', '/Rotate'):
+      if attr in node: inherit[attr] = node[attr]
+    for kid in node['/Kids']:
+      obj = kid.getObject()
+      count = int(obj['/Count']) if '/Kids' in obj else 1
+      if idx < count: break
+      idx -= count
     else:
-      dom = ET.parse(from_child)
-  except Exception as e:
-    print(" ".join(pdftohtml_cmd + [infile]))
-    if relaxed:
-      parser.exit("pdftohtml -xml failed.\nET.parse: " + str(e) + ")\n\n" + parser.format_usage())
+      raise IndexError("page %d not found in page tree" % nr)
+    ref, node = kid, obj
+  for attr, value in inherit.items():
+    if not attr in node: node[Pdf.NameObject(attr)] = value
+  page = PageObject(reader, ref if isinstance(ref, Pdf.IndirectObject) else None)
+  page.update(node)
+  memo[nr] = page
+  return page
+
+def mat_mul(m, n):
+  """ the product of two pdf matrices [a b c d e f] """
+  return (m[0]*n[0] + m[1]*n[2], m[0]*n[1] + m[1]*n[3],
+          m[2]*n[0] + m[3]*n[2], m[2]*n[1] + m[3]*n[3],
+          m[4]*n[0] + m[5]*n[2] + n[4], m[4]*n[1] + m[5]*n[3] + n[5])
+
+def hex2unicode(h):
+  if len(h) % 2: h += '0'
+  return binascii.unhexlify(h).decode('utf-16-be', 'replace')
+
+def parse_tounicode(data):
+  """ returns a dict mapping character codes to unicode strings,
+      from the bfchar and bfrange sections of a ToUnicode CMap.
+  """
+  cmap = {}
+  for block in re.findall(r'beginbfchar(.*?)endbfchar', data, re.S):
+    for src, dst in re.findall(r'<([0-9a-fA-F]+)>\s*<([0-9a-fA-F]*)>', block):
+      cmap[int(src, 16)] = hex2unicode(dst)
+  for block in re.findall(r'beginbfrange(.*?)endbfrange', data, re.S):
+    for lo, hi, dst in re.findall(r'<([0-9a-fA-F]+)>\s*<([0-9a-fA-F]+)>\s*(<[0-9a-fA-F]*>|\[[^\]]*\])', block):
+      lo = int(lo, 16)
+      hi = min(int(hi, 16), lo + 0xffff)
+      if dst[0] == '[':
+        for k, d in enumerate(re.findall(r'<([0-9a-fA-F]*)>', dst)):
+          cmap[lo+k] = hex2unicode(d)
+      elif len(dst) > 2:
+        d = dst[1:-1]
+        for c in range(lo, hi+1):
+          cmap[c] = hex2unicode('%0*x' % (len(d), int(d, 16) + c - lo))
+  return cmap
+
+class PypdfFont(object):
+  """ what pypdf2pages() needs to know about a font resource: its family,
+      and for each character code its text and its width in 1/1000 of the
+      font size. Simple fonts have one byte codes, Type0 fonts two bytes.
+      Text comes from the ToUnicode CMap, else simple fonts are taken as cp1252.
+      Without /Widths, the standard 14 fonts are measured with reportlab.
+  """
+  def __init__(self, font):
+    self.family = re.sub(r'^[A-Z]{6}\+', '', str(font.get('/BaseFont', 'Helvetica')).lstrip('/'))
+    self.widths = {}
+    self.default_width = 500.0
+    self.code_bytes = 1
+    if font.get('/Subtype') == '/Type0':
+      self.code_bytes = 2
+      desc = font['/DescendantFonts'][0].getObject()
+      self.default_width = float(desc['/DW']) if '/DW' in desc else 1000.0
+      w = [x.getObject() for x in desc['/W']] if '/W' in desc else []
+      i = 0
+      while i+1 < len(w):
+        if isinstance(w[i+1], list):    # c [w1 w2 ...]
+          for k, x in enumerate(w[i+1]):
+            self.widths[int(w[i])+k] = float(x.getObject())
+          i += 2
+        else:                           # c_first c_last w
+          for c in range(int(w[i]), int(w[i+1])+1):
+            self.widths[c] = float(w[i+2])
+          i += 3
+    elif '/Widths' in font:
+      first = int(font['/FirstChar']) if '/FirstChar' in font else 0
+      for k, x in enumerate(font['/Widths']):
+        self.widths[first+k] = float(x.getObject())
+      if '/FontDescriptor' in font and '/MissingWidth' in font['/FontDescriptor']:
+        self.default_width = float(font['/FontDescriptor']['/MissingWidth'])
     else:
-      return None
-  print("pdf2xml done")
-  return dom
+      try:
+        for c in range(32, 256):
+          self.widths[c] = pdfmetrics.stringWidth(chr(c).decode('cp1252', 'replace'), self.family, 1000)
+      except Exception:
+        pass                            # not a standard font
+    self.to_unicode = {}
+    if '/ToUnicode' in font:
+      self.to_unicode = parse_tounicode(font['/ToUnicode'].getData())
+
+  def codes(self, data):
+    """ yields (text, width) for each character code in the byte string data. """
+    n = self.code_bytes
+    for i in range(0, len(data) - n + 1, n):
+      c = ord(data[i])
+      if n == 2: c = c*256 + ord(data[i+1])
+      text = self.to_unicode.get(c)
+      if text is None:
+        text = chr(c).decode('cp1252', 'replace') if n == 1 else u'\ufffd'
+      yield (text, self.widths.get(c, self.default_width), c)
+
+pypdf_lock = threading.Lock()
+
+def pypdf2pages(parser, infile, key='', firstpage=None, lastpage=None, jobs=1, zoom=1.5):
+  """ an in-process alternative to pdf2xml(): extracts the text runs of a
+      pdf file directly from the page content streams with pyPdf, no pdftohtml
+      and no xml involved. Returns the same list of PdfPage objects.
+      Coordinates are scaled by zoom, like pdftohtml does.
+      The text operators BT ET Tf Td TD Tm T* TL Tc Tw Tz Ts Tj TJ ' " are
+      interpreted, with cm q Q and form XObjects. Horizontal text only.
+      Consecutive strings on one baseline in the same font are merged into one
+      TextRun, a space is inserted for gaps wider than 0.15 of the font size.
+      pyPdf is not thread safe, and this is pure python anyway: one at a time.
+  """
+  with pypdf_lock:
+    reader = open_pdf(parser, infile, key)
+    n = pdf_num_pages(reader)
+    first = int(firstpage or 1)
+    last = min(int(lastpage or n), n)
+    fonts = {}                  # (family, size) -> id, as with pdftohtml
+    font_res = {}               # font resource -> PypdfFont
+    pages = []
+    for p_nr in range(first, last+1):
+      pages.append(pypdf_page(reader, p_nr, zoom, fonts, font_res))
+  print("pypdf2pages done")
+  return pages
+
+def pypdf_page(reader, p_nr, zoom, fonts, font_res):
+  """ converts page p_nr of reader into a PdfPage, see pypdf2pages(). """
+  page = pdf_page(reader, p_nr-1)
+  mbox = [float(v) for v in page.mediaBox]
+  p = PdfPage(p_nr, 0.0, 0.0, (mbox[2]-mbox[0])*zoom, (mbox[3]-mbox[1])*zoom)
+  runs = []                     # [font_id, size, baseline, x1, x2, text]
+
+  def show(ts, data):
+    font = ts['font']
+    if font is None: return
+    m = mat_mul(ts['tm'], ts['ctm'])
+    size = math.sqrt(m[2]*m[2] + m[3]*m[3]) * ts['tfs'] * zoom
+    x1 = (ts['trise']*m[2] + m[4] - mbox[0]) * zoom
+    y = (mbox[3] - ts['trise']*m[3] - m[5]) * zoom
+    text = u''
+    tx = 0.0
+    for t, w, c in font.codes(data):
+      text += t
+      tx += (w/1000.0*ts['tfs'] + ts['tc'] + (ts['tw'] if c == 32 and font.code_bytes == 1 else 0)) * ts['th']
+    advance(ts, tx)
+    x2 = (mat_mul(ts['tm'], ts['ctm'])[4] + ts['trise']*m[2] - mbox[0]) * zoom
+    f_key = (font.family, int(0.5+size))
+    if not f_key in fonts:
+      fonts[f_key] = str(len(fonts))
+      p.fonts.append({'id':fonts[f_key], 'size':str(f_key[1]), 'family':font.family, 'color':'#000000'})
+    if len(runs):
+      r = runs[-1]
+      gap = x1 - r[4]
+      if r[0] == fonts[f_key] and abs(y - r[2]) < 0.2*size and -0.2*size <= gap <= size:
+        if gap > 0.15*size and not r[5].endswith(' ') and not text.startswith(' '):
+          r[5] += ' '
+        r[5] += text
+        r[4] = max(r[4], x2)
+        return
+    runs.append([fonts[f_key], size, y, x1, x2, text])
+
+  def advance(ts, tx):
+    tm = ts['tm']
+    ts['tm'] = (tm[0], tm[1], tm[2], tm[3], tx*tm[0] + tm[4], tx*tm[1] + tm[5])
+
+  def move(ts, tx, ty):
+    tlm = ts['tlm']
+    ts['tm'] = ts['tlm'] = (tlm[0], tlm[1], tlm[2], tlm[3],
+                            tx*tlm[0] + ty*tlm[2] + tlm[4], tx*tlm[1] + ty*tlm[3] + tlm[5])
+
+  def run_content(content, resources, ts, depth=0):
+    stack = []
+    for operands, op in ContentStream(content, reader).operations:
+      if op == 'q':
+        stack.append(ts.copy())
+      elif op == 'Q':
+        if len(stack): ts = stack.pop()
+      elif op == 'cm':
+        ts['ctm'] = mat_mul([float(v) for v in operands], ts['ctm'])
+      elif op == 'BT':
+        ts['tm'] = ts['tlm'] = (1, 0, 0, 1, 0, 0)
+      elif op == 'Tf':
+        f_ref = None
+        if '/Font' in resources and operands[0] in resources['/Font']:
+          f_ref = resources['/Font'].raw_get(operands[0])
+        if f_ref is None:
+          ts['font'] = None
+        else:
+          f_key = (f_ref.idnum, f_ref.generation) if isinstance(f_ref, Pdf.IndirectObject) else id(f_ref)
+          if not f_key in font_res:
+            font_res[f_key] = PypdfFont(f_ref.getObject())
+          ts['font'] = font_res[f_key]
+        ts['tfs'] = float(operands[1])
+      elif op == 'Tc': ts['tc'] = float(operands[0])
+      elif op == 'Tw': ts['tw'] = float(operands[0])
+      elif op == 'Tz': ts['th'] = float(operands[0])/100
+      elif op == 'TL': ts['tl'] = float(operands[0])
+      elif op == 'Ts': ts['trise'] = float(operands[0])
+      elif op == 'Td':
+        move(ts, float(operands[0]), float(operands[1]))
+      elif op == 'TD':
+        ts['tl'] = -float(operands[1])
+        move(ts, float(operands[0]), float(operands[1]))
+      elif op == 'Tm':
+        ts['tm'] = ts['tlm'] = tuple([float(v) for v in operands])
+      elif op == 'T*':
+        move(ts, 0, -ts['tl'])
+      elif op == 'Tj':
+        show(ts, operands[0].original_bytes)
+      elif op == "'":
+        move(ts, 0, -ts['tl'])
+        show(ts, operands[0].original_bytes)
+      elif op == '"':
+        ts['tw'] = float(operands[0])
+        ts['tc'] = float(operands[1])
+        move(ts, 0, -ts['tl'])
+        show(ts, operands[2].original_bytes)
+      elif op == 'TJ':
+        for e in operands[0]:
+          if isinstance(e, (Pdf.ByteStringObject, Pdf.TextStringObject)):
+            show(ts, e.original_bytes)
+          else:
+            advance(ts, -float(e)/1000*ts['tfs']*ts['th'])
+      elif op == 'Do' and depth < 10 and '/XObject' in resources and operands[0] in resources['/XObject']:
+        xobj = resources['/XObject'][operands[0]]
+        if xobj.get('/Subtype') == '/Form':
+          inner = ts.copy()
+          if '/Matrix' in xobj:
+            inner['ctm'] = mat_mul([float(v) for v in xobj['/Matrix']], ts['ctm'])
+          run_content(xobj, xobj['/Resources'] if '/Resources' in xobj else resources, inner, depth+1)
+
+  content = page.getContents()
+  if content is not None:
+    ts = {'ctm':(1, 0, 0, 1, 0, 0), 'tm':(1, 0, 0, 1, 0, 0), 'tlm':(1, 0, 0, 1, 0, 0), 'font':None,
+          'tfs':0.0, 'tc':0.0, 'tw':0.0, 'th':1.0, 'tl':0.0, 'trise':0.0}
+    run_content(content, page['/Resources'] if '/Resources' in page else {}, ts)
+  for f_id, size, y, x1, x2, text in runs:
+    if len(text.strip()):
+      p.texts.append(TextRun(text, x1, y-size, x2-x1, size, f_id, p.h))
+  return p
+
+extractors = {
+  'pdftohtml': pdf2xml,
+  'pypdf':     pypdf2pages,
+}
+
+def extractor_version(name):
+  """ identifies the text extractor for cache keys. """
+  if name == 'pdftohtml': return pdftohtml_version()
+  return name + " " + __VERSION__
+
+cache_format = 3       # increment, whenever the layout of cached data changes.
+
+def file_digest(fname, memo={}):
+  """ returns the sha1 hexdigest of the contents of the named file.
+      Computed once per file and run.
+  """
+  if not fname in memo:
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+      while True:
+        data = f.read(1<<20)
+        if not data: break
+        h.update(data)
+    memo[fname] = h.hexdigest()
+  return memo[fname]
+
+def pdftohtml_version(memo={}):
+  """ returns the version line of pdftohtml, so that cached results
+      of one pdftohtml version are not used with another.
+  """
+  if not 'v' in memo:
+    try:
+      p = subprocess.Popen(["pdftohtml", "-v"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+      memo['v'] = p.communicate()[0].decode('utf-8', 'replace').strip().split("\n")[0]
+    except OSError as e:
+      memo['v'] = "unknown: " + str(e)
+  return memo['v']
+
+def cache_path(cache_dir, kind, key):
+  """ returns the file name in cache_dir, where data of the given kind
+      is kept for key. key is a list of everything the data depends on.
+  """
+  key = repr([cache_format, kind] + list(key))
+  return os.path.join(cache_dir, "%s-%s.pkz" % (kind, hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+def cache_load(fname):
+  """ returns the data stored by cache_store(), or None. """
+  try:
+    with open(fname, 'rb') as f:
+      data = pickle.loads(zlib.decompress(f.read()))
+  except (IOError, OSError):
+    return None
+  except Exception as e:
+    print("cache_load %s failed: %s" % (fname, e))
+    return None
+  print("cache hit: %s" % fname)
+  return data
+
+def cache_store(fname, data):
+  """ writes data as a compressed pickle. Readers never see a partial file.
+      Any failure only costs the cache entry, the run goes on.
+  """
+  tmp = "%s.%d.tmp" % (fname, os.getpid())
+  try:
+    blob = zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+    d = os.path.dirname(fname)
+    if d and not os.path.isdir(d):
+      os.makedirs(d)
+    with open(tmp, 'wb') as f:
+      f.write(blob)
+    os.rename(tmp, fname)
+  except Exception as e:
+    print("cache_store %s failed: %s" % (fname, e))
+    try:
+      os.unlink(tmp)
+    except OSError:
+      pass
+
+def wordlist2cache(wl):
+  """ the picklable parts of a WordList as returned by xml2wordlist():
+      its line texts and word arrays, and the contexts as tuples.
+  """
+  return {'texts': wl.texts, 'line': wl.line, 'off': wl.off, 'len': wl.len,
+          'contexts': [tuple([c[k] for k in ('p','l','x','y','w','h','f')]) for c in wl.contexts]}
+
+def cache2wordlist(data):
+  """ the inverse of wordlist2cache(). Returns None, if data is None. """
+  if data is None: return None
+  wl = WordList()
+  wl.texts = data['texts']
+  wl.contexts = [dict(zip(('p','l','x','y','w','h','f'), c)) for c in data['contexts']]
+  wl.line = data['line']
+  wl.off = data['off']
+  wl.len = data['len']
+  return wl
 
 class DecoratedWord(list):
   """Usage in pdfcompare is:
@@ -469,7 +1098,7 @@ class DecoratedWord(list):
      found; word[2] is the index position into word[1], and word[3] is a set of
      attributes, as follows:
      Elements of word[3] are:
-     {'f': '3', 's':'stem', 'h': '10', 'l': 'b', 'p': 2, 'w': '151', 'x': '540', 'y': '1209'}
+     {'f': '3', 's':'stem', 'h': 10.0, 'l': 'b', 'p': 2, 'w': 151.0, 'x': 540.0, 'y': 1209.0}
      Where f is the font index; l is the location on the page as in t(op),
      m(iddle), b(ottom); p is the physical page number; x,y,w,h define the
      bounding box of word[1]; and s is a substring (without digits or
@@ -482,10 +1111,72 @@ class DecoratedWord(list):
   def __hash__(self):
     return hash(self[0])
 
+class WordList(object):
+  """ a compact list of words, as returned by xml2wordlist() and friends.
+      Lines are stored once: texts and contexts have one entry per line,
+      all words of a line share them. Per word, only three numbers are stored
+      in the arrays line, off and len: the line index, the offset of the 
+      word in the line text and its length.
+      wl[i] returns the word as a DecoratedWord [word, text, off, context],
+      created on the fly. A slice returns a list of those.
+  """
+  __slots__ = ('texts', 'contexts', 'line', 'off', 'len')
+
+  def __init__(self):
+    self.texts = []
+    self.contexts = []
+    self.line = array('i')
+    self.off = array('i')
+    self.len = array('i')
+
+  def add_line(self, text, context):
+    """ returns the line index for add_word(). """
+    self.texts.append(text)
+    self.contexts.append(context)
+    return len(self.texts)-1
+
+  def add_word(self, line, off, length):
+    self.line.append(line)
+    self.off.append(off)
+    self.len.append(length)
+
+  def add_split(self, text, context):
+    """ adds the words of text.split() as one line. """
+    words = text.split()
+    if not len(words): return
+    line = self.add_line(text, context)
+    idx = 0
+    for w in words:
+      idx = text.index(w, idx)
+      self.add_word(line, idx, len(w))
+      idx += len(w)
+
+  def __len__(self):
+    return len(self.line)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[k] for k in range(*i.indices(len(self)))]
+    l = self.line[i]
+    off = self.off[i]
+    text = self.texts[l]
+    return DecoratedWord([text[off:off+self.len[i]], text, off, self.contexts[l]])
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def words(self):
+    """ yields only the word strings. """
+    texts = self.texts
+    for i in range(len(self)):
+      off = self.off[i]
+      yield texts[self.line[i]][off:off+self.len[i]]
+
 def xmlfile2wordlist(fname):
   """ works well with xml from pdftohtml -xml.
       """
-  wl = []
+  wl = WordList()
   elementcount = 0
 
   #tree= ET.parse(fname)
@@ -511,8 +1202,8 @@ def xmlfile2wordlist(fname):
       ## but we want to count elements.
       # t = "".join(elem.itertext())
       if elem.text:
-        for w in elem.text.split():
-          wl.append(DecoratedWord([w,None,None,{'e':elementcount, 'l':f.lineno}]))
+        # all words of one element share their context, see wordlist_lines()
+        wl.add_split(elem.text, {'e':elementcount, 'l':f.lineno})
   return wl
 
 def textfile2wordlist(fname):
@@ -520,14 +1211,56 @@ def textfile2wordlist(fname):
       things may appear in different ordering than with pdftohtml, resulting
       in an enormous diff.
       """
-  wl = []
+  wl = WordList()
   # assume .txt files are utf8 encoded, but please survive binary garbage.
   with codecs.open(fname, 'r', 'utf-8', errors='ignore') as f:
     for lnr, line in enumerate(f):
-      for w in line.split():
-        wl.append(DecoratedWord([w,None,None,{'l':lnr}]))
+      wl.add_split(line, {'l':lnr})
   return wl
 
+def intern_wordlist(wl, table):
+  """ returns an array of small integers, one per word in wl.
+      Identical words get identical numbers. The table dict maps words to
+      numbers. Use the same table for both wordlists that are compared.
+      Diffing these arrays is much cheaper than diffing DecoratedWords,
+      as their compare and hash methods are implemented in python.
+  """
+  return array('i', [table.setdefault(w, len(table)) for w in wl.words()])
+
+def wordlist_lines(wl):
+  """ returns an array with the index of the first word of each line in wl,
+      followed by len(wl). For words from pdftohtml, a line is a <text> element.
+  """
+  starts = array('i')
+  prev = None
+  for i, l in enumerate(wl.line):
+    if l != prev:
+      starts.append(i)
+      prev = l
+  starts.append(len(wl))
+  return starts
+
+def wordlist_pages(wl):
+  """ like wordlist_lines(), but returns where each page starts.
+      Words without page numbers are all on one page.
+  """
+  starts = array('i')
+  prev = None
+  for i, l in enumerate(wl.line):
+    p = wl.contexts[l].get('p')
+    if i == 0 or p != prev:
+      starts.append(i)
+      prev = p
+  starts.append(len(wl))
+  return starts
+
+def intern_ranges(ids, starts, table):
+  """ like intern_wordlist(), but each range ids[starts[k]:starts[k+1]]
+      gets one number. Identical lines (or pages) get identical numbers.
+  """
+  return array('i', [table.setdefault(tuple(ids[starts[k]:starts[k+1]]), len(table))
+                     for k in range(len(starts)-1)])
+
 def bbox_inside(bb1, bb2):
   """ checks if bb2 is inside the bounding box bb1.
       The bounding box format is [x1,y1,x2,y2].
@@ -545,96 +1278,107 @@ def bbox_inside(bb1, bb2):
   if bb2[3] > bb1[3]: return False
   return True
 
-def bbox_overlap(bb1, bb2):
-  """ bb1 and bb2 are expected as four element rectangles in the format
-      [x1,y1,x2,y2]. Returns True if any corner of bb2 is in bb1 
-                               or if any corner of bb1 is in bb2.
-      That should be a valid overlap test, no?
+def bbox_run_class(bbox, r):
+  """ classifies a TextRun r for the margins bbox: returns 1, if all of r is
+      inside bbox, -1 if none of its words can overlap bbox, and 0 if its
+      words need to be tested with bbox_words().
   """
-  x1,y1,x2,y2 = bb2
-  if bbox_inside(bb1, [x1,y1]): return True
-  if bbox_inside(bb1, [x1,y2]): return True
-  if bbox_inside(bb1, [x2,y2]): return True
-  if bbox_inside(bb1, [x2,y1]): return True
-  x1,y1,x2,y2 = bb1
-  if bbox_inside(bb2, [x1,y1]): return True
-  if bbox_inside(bb2, [x1,y2]): return True
-  if bbox_inside(bb2, [x2,y2]): return True
-  if bbox_inside(bb2, [x2,y1]): return True
-  return False
-
-def in_bbox_interpolated(bbox, word):
-  """calculate an approximation of the on-page position of word[0].
-     We use the known coordinates word[3]['x,y,w,h] of the text word[1], 
-     in which word[0] is contained as a substring starting at position word[2].
-     A simple constant width character interpolation is done for speed.
-     A more excat interpolation is possible using the font metrics word[3]['f']
-  """
-  if bbox is None: 
-    return True  # the undefined bounding box includes all
-
-  # coordinates of word[1]
-  x1 = float(word[3]['x'])
-  x2 = float(word[3]['w']) + x1
-  y1 = float(word[3]['y'])
-  y2 = float(word[3]['h']) + y1
+  x1 = r['x']
+  x2 = r['w'] + x1
+  y1 = r['y']
+  y2 = r['h'] + y1
   if bbox_inside(bbox, [x1,y1,x2,y2]):
-    return True # fast track. All of word[1] is in, so the word[0] is also in.
-
-  if not len(word[1]): return False     # zero-size and not completly in, means out.
-
-  i = word[2]
-  l = len(word[0])
-  char_width = float(x2-x1)/len(word[1])
-  x1 += i * char_width
-  x2 = x1 + l * char_width
-  # Given the fast track above, maybe for the rest, a
-  # correct font metrics interpolation is affordable?
-  # The impact is linear with the input text size, beware.
-  # Currently impact of metrics calculation is only linar with the 
-  # result set size.
-  if bbox_overlap(bbox, [x1,y1,x2,y2]):
-    return True         
-  return False
+    return 1
+  if x2 >= x1 and y2 >= y1:
+    # words lie within the run, but the interpolated right end of the last
+    # word may be off by a rounding error.
+    if y1 > bbox[3] or y2 < bbox[1] or x1 > bbox[2] or x2 + 1e-6*(x2-x1+1) < bbox[0]:
+      return -1
+  return 0
+
+def bbox_words(bbox, r, off, n):
+  """ returns the indices k of those words r.text[off[k]:off[k]+n[k]] of the
+      TextRun r, that overlap bbox: a corner of the word is in bbox, or a
+      corner of bbox is in the word. The position of a word is interpolated
+      with a constant character width, its y coordinates are those of r.
+  """
+  text = r.text
+  if not len(text): return []
+  bx1, by1, bx2, by2 = bbox
+  x1 = r['x']
+  x2 = r['w'] + x1
+  y1 = r['y']
+  y2 = r['h'] + y1
+  char_width = float(x2-x1)/len(text)
+  word_y = (by1 <= y1 <= by2) or (by1 <= y2 <= by2)     # a word corner is in bbox
+  bbox_y = (y1 <= by1 <= y2) or (y1 <= by2 <= y2)       # a bbox corner is in the word
+  keep = []
+  for k in range(len(off)):
+    wx1 = x1 + off[k] * char_width
+    wx2 = wx1 + n[k] * char_width
+    if (word_y and (bx1 <= wx1 <= bx2 or bx1 <= wx2 <= bx2)) or \
+       (bbox_y and (wx1 <= bx1 <= wx2 or wx1 <= bx2 <= wx2)):
+      keep.append(k)
+  return keep
   
-def textline2wordlist(text, context, bbox=None):
-  """returns a list of 4-element lists like this:
-     [word, text, idx, context]
-     where the word was found in the text string at offset idx.
+re_word = re.compile("\S+")
+
+def page2wordlist(runs, bbox=None, wl=None):
+  """adds the words of a page, given as a list of TextRun objects,
+     to the WordList wl, and returns wl.
+     A new WordList is started, if wl is None.
+     Each word is found in the text of its run at some offset idx, wl[i]
+     returns it as [word, run.text, idx, run].
      words are defined as any printable text delimited by whitespace.
      just as str.split() would do.
-     Those 4-element lists are cast into DecoratedWord.
-     The DecoratedWord type extends the list type, so that it is hashable and
-     comparable using only the "word" which is the first element of the four. 
-     Thus our wordlists work well as sequences with difflib, although they also
-     transport all the context to compute exact page positions later.
+     All texts of the page are tokenized in one pass: joined with newlines,
+     no word can span two runs.
 
      A bbox (x1,y1, x2, y2) with x1 < x2, y1 < y2 can be specified to prefilter
      the wordlist. Only words that are (at least partially) inside the bbox
-     will be returned.
+     will be added. Runs outside are dropped before tokenization, runs inside
+     are taken as a whole, see bbox_run_class().
   """
 
-  wl = []
-  idx = 0
-  tl = re.split("(\s+)", text)
-  while True:
-    if len(tl)==0: break
-    head = tl.pop(0)
-    if len(head):
-      word = [head, text, idx, context]
-      if in_bbox_interpolated(bbox, word):
-        wl.append(DecoratedWord(word))
-    if len(tl)==0: break
-    sep = tl.pop(0)
-    idx += len(sep)+len(head)
+  if wl is None: wl = WordList()
+  partial = ()
+  if bbox is not None:
+    classes = [bbox_run_class(bbox, r) for r in runs]
+    partial = set([id(r) for r, c in zip(runs, classes) if c == 0])
+    runs = [r for r, c in zip(runs, classes) if c >= 0]
+  page_text = "\n".join([r.text for r in runs])
+  spans = [m.span() for m in re_word.finditer(page_text)]
+  w_start = array('i', [s for s, e in spans])
+  w_len = array('i', [e - s for s, e in spans])
+  lo = 0
+  start = 0                     # of run r in page_text
+  for r in runs:
+    end = start + len(r.text)
+    hi = bisect.bisect_left(w_start, end, lo)
+    if hi > lo:
+      off = [s - start for s in w_start[lo:hi]]
+      n = w_len[lo:hi]
+      if id(r) in partial:
+        keep = bbox_words(bbox, r, off, n)
+        off = [off[i] for i in keep]
+        n = [n[i] for i in keep]
+      if len(off):
+        line = wl.add_line(r.text, r)
+        wl.line.extend([line] * len(off))
+        wl.off.extend(off)
+        wl.len.extend(n)
+    lo = hi
+    start = end + 1
   return wl
   
-def xml2wordlist(dom, first_page=None, last_page=None, margins=None):
-  """input: a dom tree as generated by pdftohtml -xml.
-     first_page, last_page start counting at 0.
+def xml2wordlist(pages, first_page=None, last_page=None, margins=None):
+  """input: a list of PdfPage objects as generated by pdf2xml().
+     first_page, last_page start counting at 0. Pages are selected by their
+     page number p.nr, so pages may or may not be already restricted by
+     the extractor. Each word records its page number p.nr as 'p'.
      If margins is not None, the coordinates of all words are filtered against 
      a bounding box constructed by reducing the page box.
-     output: a wordlist with all the metadata so that the exact coordinates
+     output: a WordList with all the metadata so that the exact coordinates
              of each word can be calculated.
   """
   ## Caution: 
@@ -645,17 +1389,17 @@ def xml2wordlist(dom, first_page=None, last_page=None, margins=None):
   ## Seen in atmega164_324_644_1284_8272S.pdf
 
   if first_page is None: first_page = 0
-  wl=[]
-  p_nr = 0
-  for p in dom.findall('page'):
+  wl = WordList()
+  n = 0
+  for p in pages:
     if not last_page is None:
-      if p_nr > int(last_page):
+      if p.nr > int(last_page)+1:
         break
-    p_nr += 1
-    if p_nr <= int(first_page):
+    if p.nr <= int(first_page):
       continue
-    p_h = float(p.attrib['height'])
-    p_w = float(p.attrib['width'])
+    n += 1
+    p_h = p.h
+    p_w = p.w
 
     # default bounding box is entire page:
     # bbox ordering is x1,y1, x2, y2 where x1,y1 are the smaller values.
@@ -663,55 +1407,194 @@ def xml2wordlist(dom, first_page=None, last_page=None, margins=None):
     if margins is not None:
       p_bbox = (margins['n'], margins['w'], p_w - margins['e'], p_h - margins['s'])
 
-    for e in p.findall('text'):
-      # <text font="0" height="19" left="54" top="107" width="87"><b>Features</b></text>
-      x=e.attrib['left']
-      y=e.attrib['top']
-      w=e.attrib['width']
-      h=e.attrib['height']
-      f=e.attrib['font']
-      text = ''
-      for t in e.itertext(): text += t
-
-      ## crude top,center,bottom location
-      if   float(y) > 0.66*p_h: l = 'b'
-      elif float(y) > 0.33*p_h: l = 'c'
-      else:                     l = 't'
-      wl += textline2wordlist(text, {'p':p_nr, 'l':l, 'x':x, 'y':y, 'w':w, 'h':h, 'f':f}, p_bbox)
+    for r in p.texts:
+      r['p'] = p.nr
+    page2wordlist(p.texts, p_bbox, wl)
     #pprint(wl)
-  print("xml2wordlist: %d pages" % (p_nr-int(first_page)))
+  print("xml2wordlist: %d pages" % n)
   return wl
 
-def xml2fontinfo(dom, last_page=None):
-  # last_page starts counting at 0 and is inclusive.
-  finfo = [None]      # each page may add (or overwrite?) some fonts
-  p_finfo = {}
-  p_nr = 0
-  for p in dom.findall('page'):
+PGF = None                      # pygame.font, imported by have_pygame() on first use
+
+def pygame_font(family, size):
+  """ returns (file, font) with a pygame.font.Font for family at size. """
+  if not have_pygame():
+    raise ImportError("pygame_font: no module pygame.font, try --font-metrics reportlab")
+  if not PGF.get_init(): PGF.init()
+  f_file = PGF.match_font(family)
+  ######
+  # On openSUSE 12.1 Beta 1 (i586,fossy) the call to PGF.Font() triggers this warning:
+  # /usr/lib/python2.7/site-packages/pygame/pkgdata.py:27: UserWarning:
+  # Module argparse was already imported from
+  # /usr/lib/python2.7/argparse.pyc, but /usr/lib/python2.7/site-packages
+  # is being added
+  return (f_file, PGF.Font(f_file, size))
+
+class ReportlabFont(object):
+  """ font metrics from reportlab's stringWidth(), with a metrics() method
+      like pygame.font.Font, as far as glyph_widths() needs it:
+      the 5th element of each tuple is the advance width.
+  """
+  def __init__(self, name, size):
+    self.name = name
+    self.size = size
+
+  def metrics(self, text):
+    return [(0, 0, 0, 0, pdfmetrics.stringWidth(c, self.name, self.size)) for c in text]
+
+def standard_font(family):
+  """ the closest of the 14 standard PDF fonts, whose metrics reportlab has built in. """
+  f = family.lower()
+  if 'courier' in f or 'mono' in f:
+    base = ('Courier', 'Courier-Bold', 'Courier-Oblique', 'Courier-BoldOblique')
+  elif 'times' in f or ('serif' in f and not 'sans' in f):
+    base = ('Times-Roman', 'Times-Bold', 'Times-Italic', 'Times-BoldItalic')
+  else:
+    base = ('Helvetica', 'Helvetica-Bold', 'Helvetica-Oblique', 'Helvetica-BoldOblique')
+  return base[('bold' in f) + 2*('italic' in f or 'oblique' in f)]
+
+def reportlab_font(family, size):
+  """ returns (file, font) like pygame_font(), without pygame: fc-match
+      finds the TrueType file for family, which reportlab parses.
+      Without fontconfig, or for fonts reportlab cannot read, the
+      standard_font() metrics are used, and file is None.
+  """
+  try:
+    f_file = subprocess.Popen(['fc-match', '-f', '%{file}', family],
+                              stdout=subprocess.PIPE).communicate()[0]
+  except OSError:
+    f_file = ''
+  if f_file.lower().endswith(('.ttf', '.otf')):
+    try:
+      if not f_file in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont(f_file, f_file))
+      return (f_file, ReportlabFont(f_file, size))
+    except (TTFError, IOError) as e:
+      if debug: print("reportlab_font: %s: %s" % (f_file, e))
+  return (None, ReportlabFont(standard_font(family), size))
+
+def have_pygame():
+  """ imports pygame.font as PGF on first use. Returns False, if it is not installed. """
+  global PGF
+  if PGF is None:
+    try:
+      import pygame.font as PGF
+    except ImportError:
+      return False
+  return True
+
+font_backends = {
+  'pygame':    pygame_font,
+  'reportlab': reportlab_font,
+}
+font_metrics = 'auto'           # a key of font_backends, or 'auto': pygame if available. See --font-metrics
+
+font_cache = OrderedDict()      # (family, size) -> (file, CachedFont), most recently used last
+font_cache_size = 64
+
+class CachedFont(object):
+  """ a font as kept in font_cache, with the metrics() method of the font it wraps.
+      Each character is measured only once, its metrics are kept here and are
+      dropped together with the font_cache entry.
+  """
+  def __init__(self, font):
+    self.font = font
+    self.glyphs = {}
+
+  def metrics(self, text):
+    glyphs = self.glyphs
+    missing = [c for c in set(text) if not c in glyphs]
+    if len(missing):
+      glyphs.update(zip(missing, self.font.metrics(u''.join(missing))))
+    return [glyphs[c] for c in text]
+
+def cached_font(family, size):
+  """ returns (file, font) for family at size rounded to an integer.
+      The font is loaded by the font_backends entry selected with font_metrics,
+      and wrapped in a CachedFont.
+      Finding and loading a font is slow, and the same few fonts
+      recur on every page and in both documents: the results are kept in
+      font_cache for the whole run, the least recently used are dropped.
+  """
+  key = (family, int(0.5+float(size)))
+  if key in font_cache:
+    entry = font_cache.pop(key)
+  else:
+    backend = font_metrics
+    if backend == 'auto':
+      backend = 'pygame' if have_pygame() else 'reportlab'
+    f_file, font = font_backends[backend](family, key[1])
+    entry = (f_file, CachedFont(font))
+    if len(font_cache) >= font_cache_size:
+      font_cache.popitem(last=False)
+  font_cache[key] = entry
+  return entry
+
+class FontInfo(dict):
+  """ an entry of the font table returned by xml2fontinfo(), with the 'name'
+      and 'size' of a fontspec. 'file' and 'font' are looked up with
+      cached_font() on first access, so that only the fonts of text that
+      receives marks are ever loaded.
+  """
+  def __missing__(self, key):
+    if not key in ('file', 'font'): raise KeyError(key)
+    self['file'], self['font'] = cached_font(self['name'], self['size'])
+    return self[key]
+
+def xml2fontinfo(pages, last_page=None):
+  """ returns the font table of the document: a dict of FontInfo indexed by font id.
+      Font ids are unique within a document, as pdftohtml declares each
+      font once, on the first page that uses it; pdf2xml_sharded() and
+      pypdf2pages() follow this. So all pages share one table.
+      last_page starts counting at 0 and is inclusive.
+  """
+  finfo = {}
+  for p in pages:
     if not last_page is None:
-      if p_nr > int(last_page):
+      if p.nr > int(last_page)+1:
         break
-    p_nr += 1
-    p_finfo = p_finfo.copy()
-    # print("----------------- page %s -----------------" % p.attrib['number'])
-
-    for fspec in p.findall('fontspec'):
-      fname = fspec.attrib.get('family', 'Helvetica')
-      fsize = fspec.attrib.get('size', 12)
-      f_id  = fspec.attrib.get('id')
-      f_file = PGF.match_font(fname)
-      ######
-      # On openSUSE 12.1 Beta 1 (i586,fossy) the call to PGF.Font() triggers this warning:
-      # /usr/lib/python2.7/site-packages/pygame/pkgdata.py:27: UserWarning:
-      # Module argparse was already imported from
-      # /usr/lib/python2.7/argparse.pyc, but /usr/lib/python2.7/site-packages
-      # is being added
-      f = PGF.Font(f_file, int(0.5+float(fsize)))
-      p_finfo[f_id] = { 'name': fname, 'size':fsize, 'file': f_file, 'font':f }
-    #pprint(p_finfo)
-    finfo.append(p_finfo)
+    # print("----------------- page %s -----------------" % p.nr)
+
+    for fspec in p.fonts:
+      f_id  = fspec.get('id')
+      if f_id in finfo: continue
+      fname = fspec.get('family', 'Helvetica')
+      fsize = fspec.get('size', 12)
+      finfo[f_id] = FontInfo(name=fname, size=fsize)
+  #pprint(finfo)
   return finfo
 
+def compare_wordlist(parser, args, margins):
+  """ loads the wordlist of OLDFILE, as named with -c.
+      Returns a tuple (wordlist, pages), where pages is None, unless OLDFILE is a
+      PDF, and it was not found in the --cache-dir.
+  """
+  pages2 = None
+  wordlist2 = None
+  if re.search('\.pdf$', args.compare_text, re.I):
+    first_page = args.first_page
+    if first_page is not None: first_page = int(first_page) - 1
+    last_page = args.last_page
+    if last_page is not None: last_page = int(last_page) - 1
+    cache_file = None
+    if args.cache_dir:
+      cache_file = cache_path(args.cache_dir, 'wordlist', [file_digest(args.compare_text),
+                              first_page, last_page, args.strict, args.decrypt_key, extractor_version(args.extractor),
+                              [margins[k] for k in ('n','e','w','s')]])
+      wordlist2 = cache2wordlist(cache_load(cache_file))
+    if wordlist2 is None:
+      pages2 = extractors[args.extractor](parser, args.compare_text, key=args.decrypt_key,
+                                          firstpage=args.first_page, lastpage=args.last_page, jobs=args.jobs)
+      wordlist2 = xml2wordlist(pages2, first_page, last_page, margins=margins)
+      if cache_file:
+        cache_store(cache_file, wordlist2cache(wordlist2))
+  elif re.search('\.xml$', args.compare_text, re.I):
+    wordlist2 = xmlfile2wordlist(args.compare_text)
+  else:
+    # assuming a plain text document
+    wordlist2 = textfile2wordlist(args.compare_text)
+  return (wordlist2, pages2)
+
 def main():
   parser = ArgumentParser(epilog="version: "+__VERSION__, description="highlight words in a PDF file.")
   parser.def_trans = 0.6
@@ -728,32 +1611,67 @@ def main():
   parser.def_margins = '0,0,0,0'
   parser.def_margins = '0,0,0,0'
   parser.def_below = False
+  parser.def_diff_algorithm = 'difflib'
+  parser.def_jobs = 1
+  parser.def_extractor = 'pdftohtml'
+  parser.def_font_metrics = 'auto'
   parser.add_argument("-c", "--compare-text", metavar="OLDFILE",
                       help="mark added, deleted and replaced text (or see -m) with regard to OLDFILE. \
                             File formats .pdf, .xml, .txt are recognized by their suffix. \
                             The comparison works word by word.")
+  parser.add_argument("--cache-dir", metavar="DIR",
+                      help="keep the extracted text of OLDFILE and the resulting marks in DIR, keyed by file contents and \
+                      the relevant options. Repeated comparisons against the same OLDFILE skip pdftohtml, repeating an \
+                      identical comparison also skips the diff. Default: no cache")
   parser.add_argument("-d", "--decrypt-key", metavar="DECRYPT_KEY", default=parser.def_decrypt_key,
                       help="open an encrypted PDF; default: KEY='"+parser.def_decrypt_key+"'")
   parser.add_argument("-e", "--exclude-irrelevant-pages", default=False, action="store_true",
                       help="with -s: show only matching pages; with -c: show only changed pages; \
                       default: reproduce all pages from INFILE in OUTFILE")
+  parser.add_argument("--extractor", metavar="NAME", default=parser.def_extractor,
+                      choices=sorted(extractors.keys()),
+                      help="how the text is taken from the PDF files. 'pdftohtml' runs pdftohtml -xml; \
+                      'pypdf' reads the page contents with pyPdf, without an external program. \
+                      Default: " + parser.def_extractor)
+  parser.add_argument("--font-metrics", metavar="NAME", default=parser.def_font_metrics,
+                      choices=['auto'] + sorted(font_backends.keys()),
+                      help="how the widths of characters are measured, to place marks inside a text. \
+                      'pygame' uses pygame.font; 'reportlab' reads TrueType fonts found with fc-match, \
+                      or uses the metrics of the standard PDF fonts. 'auto' is pygame if installed, else reportlab. \
+                      Default: " + parser.def_font_metrics)
   parser.add_argument("-f", "--features", metavar="FEATURES", default=parser.def_features,
                       help="specify how to mark. Allowed values are 'highlight', 'changebar', 'popup', \
                       'navigation', 'watermark', 'margin'. Default: " + str(parser.def_features))
   parser.add_argument("-i", "--nocase", default=False, action="store_true",
                       help="make -s case insensitive; default: case sensitive")
+  parser.add_argument("-j", "--jobs", metavar="N", type=int, default=parser.def_jobs,
+                      help="use up to N worker processes. With N > 1, long documents are extracted by up to N \
+                      pdftohtml processes, each working on a range of pages. Segments (see --segment-words) and \
+                      changed lines (see --line-diff) are diffed in parallel. Moved text also gets its second level \
+                      diff in parallel. N changes only the speed, not the result. Default: " + str(parser.def_jobs))
   parser.add_argument("-l", "--log",  metavar="LOGFILE", 
                       help="write an python datastructure describing all the overlay objects on each page. Default none.")
   parser.add_argument("-m", "--mark", metavar="OPS", default=parser.def_marks,
                       help="specify what to mark. Used with -c. Allowed values are 'add','delete','change','equal'. \
                             Multiple values can be listed comma-seperated; abbreviations are allowed.\
                             Default: " + str(parser.def_marks))
+  parser.add_argument("--line-diff", default=False, action="store_true",
+                      help="with -c: compare entire lines first, then diff words only inside changed lines. \
+                      Much faster, if most lines are unchanged. Default: diff all words")
+  parser.add_argument("--max-diff-cost", metavar="N", type=int,
+                      help="with -c: if more than N words were inserted or deleted, give up the word diff \
+                      and mark entire changed lines (or pages) instead. This puts an upper bound on the runtime \
+                      for unrelated documents. Default: unlimited")
   parser.add_argument("-n", "--no-output", default=False, action="store_true",
                       help="do not write an output file; print diagnostics only; default: write output file as per -o")
   parser.add_argument("-o", "--output", metavar="OUTFILE", default=parser.def_output,
                       help="write output to FILE; default: "+parser.def_output)
   parser.add_argument("-s", "--search", metavar="WORD_REGEXP", 
                       help="highlight WORD_REGEXP")
+  parser.add_argument("--segment-words", metavar="N", type=int,
+                      help="with -c: split the documents at unique common words into segments of about N words, \
+                      and diff each segment separately, in parallel with -j. Much faster for long documents, but \
+                      the result may differ near segment boundaries. Default: diff the entire documents at once")
   parser.add_argument("--spell", "--spell-check", default=False, action="store_true",
                       help="run the text body of the (new) pdf through hunspell. Unknown words are underlined. Use e.g. 'env DICTIONARY=de_DE ...' (or en_US, ...) to specify the spelling dictionary, if your system has more than one. Check with 'hunspell -D' and study 'man hunspell'.")
   parser.add_argument("--strict", default=False, action="store_true",
@@ -781,6 +1699,11 @@ def main():
                       help="print the version number and exit")
   parser.add_argument("-X", "--no-compression", default=False, action="store_true",
                       help="write uncompressed PDF. Default: FlateEncode filter compression.")
+  parser.add_argument("--diff-algorithm", metavar="NAME", default=parser.def_diff_algorithm,
+                      choices=sorted(diff_algorithms.keys()),
+                      help="with -c: select the word diff algorithm. 'difflib' is the classic, slow on long documents; \
+                      'myers' is fast with few changes; 'patience' splits the documents at unique common words; \
+                      'histogram' is similar, but also uses rare words. Default: " + parser.def_diff_algorithm)
   parser.add_argument("--leftside", default=False, action="store_true",
                       help="put changebars and navigation at the left hand side of the page. Default: right hand side.")
   parser.add_argument("infile", metavar="INFILE", help="the input file")
@@ -825,33 +1748,51 @@ def main():
 
   if not os.access(args.infile, os.R_OK):
     parser.exit("Cannot read input file: %s" % args.infile)
-  dom1 = pdf2xml(parser, args.infile, key=args.decrypt_key, firstpage=args.first_page, lastpage=args.last_page)
-  dom2 = None
-  wordlist2 = None
-  if args.compare_text:
-    if re.search('\.pdf$', args.compare_text, re.I):
-      dom2 = pdf2xml(parser, args.compare_text, key=args.decrypt_key, firstpage=args.first_page, lastpage=args.last_page)
-      first_page = args.first_page
-      if first_page is not None: first_page = int(first_page) - 1
-      last_page = args.last_page
-      if last_page is not None: last_page = int(last_page) - 1
-      wordlist2 = xml2wordlist(dom2, first_page, last_page, margins=margins)
-    elif re.search('\.xml$', args.compare_text, re.I):
-      wordlist2 = xmlfile2wordlist(args.compare_text)
-    else:
-      # assuming a plain text document
-      wordlist2 = textfile2wordlist(args.compare_text)
 
-  if debug:
-    dom1.write(args.output + ".1.xml")
-    if dom2:
-      dom2.write(args.output + ".2.xml")
+  if args.font_metrics == 'auto':
+    args.font_metrics = 'pygame' if have_pygame() else 'reportlab'
+  elif args.font_metrics == 'pygame' and not have_pygame():
+    parser.error("--font-metrics pygame: module pygame.font not found, try --font-metrics reportlab")
+  global font_metrics
+  font_metrics = args.font_metrics
+
+  # With --cache-dir, the marks of an earlier run with identical input
+  # files and options are reused, and we skip all text extraction and diffing.
+  # Hunspell dictionaries are not under our control, thus --spell is never cached.
+  page_marks = None
+  marks_cache_file = None
+  if args.cache_dir and not args.spell:
+    marks_cache_file = cache_path(args.cache_dir, 'marks', [__VERSION__, extractor_version(args.extractor),
+        file_digest(args.infile), args.compare_text and file_digest(args.compare_text),
+        args.first_page, args.last_page, args.decrypt_key, args.mark, args.strict,
+        args.search, args.nocase, sorted(args.search_colors.items()),
+        [margins[k] for k in ('n','e','w','s')],
+        args.diff_algorithm, args.segment_words, args.max_diff_cost, args.line_diff, args.font_metrics])
+    page_marks = cache_load(marks_cache_file)
+
+  if page_marks is None:
+    # Two pdftohtml processes can do their work in parallel.
+    old = None
+    if args.compare_text:
+      old = BackgroundCall(compare_wordlist, parser, args, margins)
+    pages1 = extractors[args.extractor](parser, args.infile, key=args.decrypt_key,
+                                        firstpage=args.first_page, lastpage=args.last_page, jobs=args.jobs)
+    pages2 = None
+    wordlist2 = None
+    if old is not None:
+      wordlist2, pages2 = old.result()
+
+    if debug:
+      pages2xml(pages1, args.output + ".1.xml")
+      if pages2:
+        pages2xml(pages2, args.output + ".2.xml")
 
-  PGF.init()
-  # This pygame.font module is used to calculate widths of all glyphs
+  # The pygame.font module (or reportlab, see --font-metrics) is used to calculate widths of all glyphs
   # for words we need to mark. With this calculation, we can determine 
   # the exact position and length of the marks, if the marked word is 
   # only a substring (which it often is).
+  # The font_backends entry selected with --font-metrics is looked up by
+  # cached_font(), when the first mark needs a font.
   # For complete strings, we get the exact positions and size from pdftohtml -xml.
   # Strings returned by pdftohtml are combinations of multiple PDF text fragments.
   # This is good, as pdftohtml reassembles words and often complete lines in a perfectly 
@@ -864,19 +1805,13 @@ def main():
   #  [(0, 8, 0, 9, 9), (0, 7, 0, 6, 6), (-1, 5, 0, 6, 4), (-1, 6, 0, 6, 6), (0, 7, 0, 6, 7), (0, 6, 0, 6, 6), (-1, 3, 0, 9, 3), (-1, 3, 0, 9, 3), (-1, 3, 0, 9, 3)]
   # (minx, maxx, miny, maxy, advance)
 
-  input1 = PdfFileReader(file(args.infile, "rb"))
-  if input1.getIsEncrypted():
-    if input1.decrypt(args.decrypt_key):
-      if len(args.decrypt_key):
-        print("Decrypted using key='%s'." % args.decrypt_key)
-    else:
-      parser.exit("decrypt(key='%s') failed." % args.decrypt_key)
+  input1 = open_pdf(parser, args.infile, args.decrypt_key)
 
   # last_page,first_page start counting at 0,
   # args.last_page, args.first_page start counting at 1.
-  last_page = input1.getNumPages()-1
+  last_page = pdf_num_pages(input1)-1
   first_page = 0
-  if args.last_page and int(args.last_page) < last_page:
+  if args.last_page and int(args.last_page)-1 < last_page:
     last_page = int(args.last_page)-1
   if args.first_page:
     first_page = int(args.first_page)-1
@@ -884,22 +1819,30 @@ def main():
       first_page = last_page
   print("input pages: %d-%d" % (first_page+1, last_page+1))
 
-  page_marks = pdfhtml_xml_find(dom1, re_pattern=args.search, 
-      wordlist=wordlist2,
-      nocase=args.nocase,
-      first_page=first_page,
-      last_page=last_page,
-      mark_ops=args.mark,
-      margins=margins,
-      strict=args.strict,
-      spell_check=args.spell,
-      move_similarity=0.75,     # 0.75 implies 1 of 1, 2 of 2, 3 of 3, 3 of 4 identical.
-      move_minwords=1,
-      ext={'a': {'c':args.search_colors['A']},
-           'd': {'c':args.search_colors['D']},
-           'c': {'c':args.search_colors['C']},
-           'm': {'c':args.search_colors['M']},
-           'e': {'c':args.search_colors['E']} })
+  if page_marks is None:
+    page_marks = pdfhtml_xml_find(pages1, re_pattern=args.search, 
+        wordlist=wordlist2,
+        nocase=args.nocase,
+        first_page=first_page,
+        last_page=last_page,
+        mark_ops=args.mark,
+        margins=margins,
+        strict=args.strict,
+        spell_check=args.spell,
+        move_similarity=0.75,     # 0.75 implies 1 of 1, 2 of 2, 3 of 3, 3 of 4 identical.
+        move_minwords=1,
+        diff_algorithm=args.diff_algorithm,
+        jobs=args.jobs,
+        max_diff_cost=args.max_diff_cost,
+        line_diff=args.line_diff,
+        segment_words=args.segment_words,
+        ext={'a': {'c':args.search_colors['A']},
+             'd': {'c':args.search_colors['D']},
+             'c': {'c':args.search_colors['C']},
+             'm': {'c':args.search_colors['M']},
+             'e': {'c':args.search_colors['E']} })
+    if marks_cache_file:
+      cache_store(marks_cache_file, page_marks)
 
   if args.log is not None:
     lf = open(args.log, "w")
@@ -937,20 +1880,20 @@ def main():
   page_idx = 0
   nav_bwd = None
   for i in range(first_page,last_page+1):
-    if not nav_bwd is None: page_marks[i]['nav_bwd'] = nav_bwd
-    if len(page_marks[i]['rect']): nav_bwd = page_idx
+    if not nav_bwd is None: page_marks[i-first_page]['nav_bwd'] = nav_bwd
+    if len(page_marks[i-first_page]['rect']): nav_bwd = page_idx
     page_idx += 1
   nav_fwd = None
   for i in range(last_page,first_page-1,-1):
     page_idx -= 1
-    if not nav_fwd is None: page_marks[i]['nav_fwd'] = nav_fwd
-    if len(page_marks[i]['rect']): nav_fwd = page_idx
+    if not nav_fwd is None: page_marks[i-first_page]['nav_fwd'] = nav_fwd
+    if len(page_marks[i-first_page]['rect']): nav_fwd = page_idx
 
   for i in range(first_page,last_page+1):
-    if args.exclude_irrelevant_pages and len(page_marks[i]['rect']) == 0:
+    if args.exclude_irrelevant_pages and len(page_marks[i-first_page]['rect']) == 0:
       continue
     hitdetails = {'equ':0, 'add':0, 'del':0, 'chg':0, 'spl':0, 'mov':0 }
-    for r in page_marks[i]['rect']:
+    for r in page_marks[i-first_page]['rect']:
       tag = r.get('t','unk')
       if not tag in hitdetails:
         hitdetails[tag] = 0
@@ -960,10 +1903,12 @@ def main():
     for det,ch in (['add','+'], ['del','-'], ['chg','~'], ['equ','='], ['mov','>'], ['spl','!']):
       if hitdetails[det]: hits_fmt += '%s%d' % (ch,hitdetails[det])
 
-    print(" page %d: %d hits %s" % (page_marks[i]['nr'], len(page_marks[i]['rect']), hits_fmt))
+    print(" page %d: %d hits %s" % (page_marks[i-first_page]['nr'], len(page_marks[i-first_page]['rect']), hits_fmt))
     # pprint(hitdetails)
+    if args.no_output:
+      continue          # diagnostics only, no need to paint anything.
 
-    page = input1.getPage(i)
+    page = pdf_page(input1, i)
     mbox = page['/MediaBox']     # landscape look like [0, 0, 794, 595]
     cbox= page.get('/CropBox', page.get('/TrimBox', mbox))
     # IBM delivers documents with 
@@ -978,8 +1923,8 @@ def main():
     pdf_str = StringIO()
     c = canvas.Canvas(pdf_str, pagesize=(mbox[2],mbox[3]))
     page_watermark(c, cbox, sys.argv, color=args.search_colors['E'], trans=args.transparency, 
-                   p_w=page_marks[i]['w'], p_h=page_marks[i]['h'], margins=margins, features=args.features)
-    page_changemarks(c, mbox, cbox, page_marks[i], i-first_page, trans=args.transparency, leftside=args.leftside, features=args.features)
+                   p_w=page_marks[i-first_page]['w'], p_h=page_marks[i-first_page]['h'], margins=margins, features=args.features)
+    page_changemarks(c, mbox, cbox, page_marks[i-first_page], i-first_page, trans=args.transparency, leftside=args.leftside, features=args.features)
 
     # c.textAnnotation('Here is a Note', Rect=[34,0,0,615], addtopage=1,Author='Test Opacity=0.1',Color=[0.7,0.8,1],Type='/Comment',Opacity=0.1)
     # c.linkURL(".: Here is a Note", (30,10,200,20), relative=0, Border="[ 1 1 1 ]")
@@ -1036,14 +1981,35 @@ def parse_margins(text,color):
           'w':float(a[2]), 's':float(a[3]), 'c':color}
 
 
-def rendered_text_width(str, font=None):
-  """Returns the width of str, in font units.
-     If font is not specified, then len(str) is returned.
+def glyph_widths(str, font):
+  """Returns a list with the advance width of each character of str, in font units.
+     Characters without a glyph have width 0.
+     """
+  return [m[4] if m else 0 for m in font.metrics(str)]
+
+prefix_width_cache = OrderedDict()     # (font, text) -> array, most recently used last
+prefix_width_cache_size = 256
+
+def rendered_text_prefix_widths(str, font=None):
+  """Returns an array where element i is the width of str[:i], in font units.
+     If font is not specified, all characters have width 1.
+     Consecutive marks are mostly placed in the same text, so the arrays
+     of recently used texts are kept in prefix_width_cache, the least
+     recently used are dropped.
      """
-  if (font is None): return len(str)
-  if (len(str) == 0): return 0
-  # return sum(map(lambda x: x[4], font.metrics(str)))
-  return sum([x[4] for x in font.metrics(str)])
+  key = (font, str)
+  if key in prefix_width_cache:
+    cum = prefix_width_cache.pop(key)
+  else:
+    cum = array('d', [0])
+    w = 0
+    for a in (glyph_widths(str, font) if font is not None else [1]*len(str)):
+      w += a
+      cum.append(w)
+    if len(prefix_width_cache) >= prefix_width_cache_size:
+      prefix_width_cache.popitem(last=False)
+  prefix_width_cache[key] = cum
+  return cum
 
 def rendered_text_pos(string1, char_start, char_count, font=None, xoff=0, width=None):
   """Returns a tuple (xoff2,width2) where substr(string1, ch_start, ch_count) will be rendered
@@ -1056,20 +2022,20 @@ def rendered_text_pos(string1, char_start, char_count, font=None, xoff=0, width=
      If width is specified, it is used to recalculate positions so that the entire string1 fits in width.
      Otherwise the values calculated by summing up font metrics by character are used directly.
      """
-  pre = string1[:char_start]
-  str = string1[char_start:char_start+char_count]
-  suf = string1[char_start+char_count:]
+  cum = rendered_text_prefix_widths(string1, font)
+  n = len(string1)
+  a = min(char_start, n)
+  b = min(char_start+char_count, n)
 
-  pre_w = rendered_text_width(pre, font)
-  str_w = rendered_text_width(str, font)
-  suf_w = rendered_text_width(suf, font)
+  pre_w = cum[a]
+  str_w = cum[b]-cum[a]
   ratio = 1
 
   if (width is not None): 
-    tot_w = pre_w+str_w+suf_w
+    tot_w = cum[n]
     if (tot_w == 0): tot_w = 1
     ratio = float(width)/tot_w
-  #pprint([[pre,str,suf,width],[pre_w,str_w,suf_w,tot_w],ratio])
+  #pprint([[string1,char_start,char_count,width],[pre_w,str_w,tot_w],ratio])
   return (xoff+pre_w*ratio, str_w*ratio)
 
 def create_mark(text,offset,length, font, t_x, t_y, t_w, t_h, ext={}):
@@ -1113,17 +2079,456 @@ def spell_check_word(w):
     return "dummy implementation. marks the words 'files', 'Nuernberg' and 'ca.'"
   return None
 
-def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={}, first_page=None, last_page=None, mark_ops="D,A,C", margins=None, strict=False, spell_check=False, move_similarity=0.95, move_minwords=10):
-  """traverse the XML dom tree, (which is expected to come from pdf2html -xml)
+def blocks2opcodes(blocks, la, lb):
+  """ convert a sorted list of matching blocks (i, j, n) into a list of
+      (tag, i1, i2, j1, j2) opcodes, exactly like SequenceMatcher.get_opcodes()
+      does. la and lb are the lengths of the two sequences.
+      Adjacent blocks are merged, so that two 'equal' never follow each other.
+  """
+  merged = []
+  for i, j, n in blocks:
+    if not n: continue
+    if merged and merged[-1][0]+merged[-1][2] == i and merged[-1][1]+merged[-1][2] == j:
+      merged[-1][2] += n
+    else:
+      merged.append([i, j, n])
+
+  opcodes = []
+  i = j = 0
+  for ai, bj, n in merged + [[la, lb, 0]]:
+    tag = ''
+    if   i < ai and j < bj: tag = 'replace'
+    elif i < ai:            tag = 'delete'
+    elif j < bj:            tag = 'insert'
+    if tag: opcodes.append((tag, i, ai, j, bj))
+    i, j = ai+n, bj+n
+    if n: opcodes.append(('equal', ai, i, bj, j))
+  return opcodes
+
+def strip_common(a, b, alo, ahi, blo, bhi, blocks):
+  """ cut off identical words at the start and end of a[alo:ahi], b[blo:bhi].
+      They are appended to blocks as matching blocks (i, j, n).
+      Returns the remaining range as a tuple (alo, ahi, blo, bhi).
+  """
+  n = 0
+  while alo+n < ahi and blo+n < bhi and a[alo+n] == b[blo+n]: n += 1
+  if n:
+    blocks.append((alo, blo, n))
+    alo += n
+    blo += n
+  n = 0
+  while alo < ahi-n and blo < bhi-n and a[ahi-n-1] == b[bhi-n-1]: n += 1
+  if n:
+    blocks.append((ahi-n, bhi-n, n))
+    ahi -= n
+    bhi -= n
+  return (alo, ahi, blo, bhi)
+
+def difflib_opcodes(a, b):
+  """ the classic: one SequenceMatcher over the entire document. """
+  return SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+
+def myers_middle_snake(a, b, alo, ahi, blo, bhi):
+  """ returns (x, y, u, v): the middle snake of a shortest edit script
+      between a[alo:ahi] and b[blo:bhi] runs from a[x],b[y] to a[u],b[v].
+      This is the linear space variant from Myers' paper "An O(ND)
+      Difference Algorithm and Its Variations" (1986). Both ranges must
+      be non-empty.
+  """
+  N = ahi-alo
+  M = bhi-blo
+  delta = N-M
+  odd = delta & 1
+  maxd = (N+M+1)//2
+  off = maxd+1
+  vf = [0] * (2*off+1)
+  vb = [0] * (2*off+1)
+  for d in range(0, maxd+1):
+    # forward path, diagonal k is x-y.
+    for k in range(-d, d+1, 2):
+      if k == -d or (k != d and vf[off+k-1] < vf[off+k+1]):
+        x = vf[off+k+1]
+      else:
+        x = vf[off+k-1]+1
+      y = x-k
+      x0 = x
+      while x < N and y < M and a[alo+x] == b[blo+y]:
+        x += 1
+        y += 1
+      vf[off+k] = x
+      if odd and -d < delta-k < d and x+vb[off+delta-k] >= N:
+        return (alo+x0, blo+x0-k, alo+x, blo+y)
+    # reverse path, on the reversed sequences.
+    for k in range(-d, d+1, 2):
+      if k == -d or (k != d and vb[off+k-1] < vb[off+k+1]):
+        x = vb[off+k+1]
+      else:
+        x = vb[off+k-1]+1
+      y = x-k
+      x0 = x
+      while x < N and y < M and a[ahi-1-x] == b[bhi-1-y]:
+        x += 1
+        y += 1
+      vb[off+k] = x
+      if not odd and -d <= delta-k <= d and x+vf[off+delta-k] >= N:
+        return (ahi-x, bhi-y, ahi-x0, bhi-x0+k)
+  raise ValueError("myers_middle_snake: no snake found")
+
+def myers_opcodes(a, b):
+  """ Myers' O(ND) diff, where D is the number of inserted and deleted words.
+      Time is proportional to the document length times the number of
+      edits, memory is linear. Good for documents with few changes.
+  """
+  blocks = []
+  todo = [(0, len(a), 0, len(b))]
+  while todo:
+    alo, ahi, blo, bhi = strip_common(a, b, *todo.pop(), blocks=blocks)
+    if alo == ahi or blo == bhi:
+      continue
+    x, y, u, v = myers_middle_snake(a, b, alo, ahi, blo, bhi)
+    if u > x: blocks.append((x, y, u-x))
+    todo.append((alo, x, blo, y))
+    todo.append((u, ahi, v, bhi))
+  blocks.sort()
+  return blocks2opcodes(blocks, len(a), len(b))
+
+def histogram_opcodes(a, b, max_chain=64):
+  """ histogram diff, as known from git. The rarest common word is
+      extended to a run of identical words, which splits the problem in two.
+      Words that occur more than max_chain times are never used for
+      splitting; regions without any usable word are handed to myers_opcodes().
+  """
+  blocks = []
+  todo = [(0, len(a), 0, len(b))]
+  while todo:
+    alo, ahi, blo, bhi = strip_common(a, b, *todo.pop(), blocks=blocks)
+    if alo == ahi or blo == bhi:
+      continue
+
+    occ = {}
+    for i in range(alo, ahi):
+      occ.setdefault(a[i], []).append(i)
+    best = None         # (count, i, j, n)
+    best_cnt = max_chain+1
+    j = blo
+    while j < bhi:
+      pos = occ.get(b[j])
+      if pos is None or len(pos) > best_cnt:
+        j += 1
+        continue
+      next_j = j+1
+      for i in pos:
+        cnt = len(pos)
+        s = 0
+        while i-s > alo and j-s > blo and a[i-s-1] == b[j-s-1]:
+          s += 1
+          cnt = min(cnt, len(occ[a[i-s]]))
+        e = 1
+        while i+e < ahi and j+e < bhi and a[i+e] == b[j+e]:
+          cnt = min(cnt, len(occ[a[i+e]]))
+          e += 1
+        next_j = max(next_j, j+e)
+        if best is None or cnt < best[0] or (cnt == best[0] and s+e > best[3]):
+          best = (cnt, i-s, j-s, s+e)
+          best_cnt = cnt
+      j = next_j
+
+    if best is None:
+      for tag, i1, i2, j1, j2 in myers_opcodes(a[alo:ahi], b[blo:bhi]):
+        if tag == 'equal': blocks.append((alo+i1, blo+j1, i2-i1))
+      continue
+    cnt, i, j, n = best
+    blocks.append((i, j, n))
+    todo.append((alo, i, blo, j))
+    todo.append((i+n, ahi, j+n, bhi))
+  blocks.sort()
+  return blocks2opcodes(blocks, len(a), len(b))
+
+def unique_anchors(a, b, alo, ahi, blo, bhi):
+  """ returns a list of (i, j) pairs, where a[i] == b[j] and the word occurs
+      exactly once in a[alo:ahi] and exactly once in b[blo:bhi].
+      Of all those candidates only the longest subsequence that is in
+      increasing order in both a and b is returned. This is the anchor
+      finding step of patience diff.
+  """
+  seen = {}     # word -> [count_a, i, count_b, j]
+  for i in range(alo, ahi):
+    s = seen.get(a[i])
+    if s is None: seen[a[i]] = [1, i, 0, None]
+    else:         s[0] += 1
+  for j in range(blo, bhi):
+    s = seen.get(b[j])
+    if s is not None:
+      s[2] += 1
+      s[3] = j
+  cand = sorted([(v[1], v[3]) for v in seen.values() if v[0] == 1 and v[2] == 1])
+  if not cand: return []
+
+  # longest increasing subsequence of the j values, patience sorting style.
+  tails = []            # j value at the end of each pile
+  tops = []             # cand index at the end of each pile
+  back = [None] * len(cand)
+  for k, (i, j) in enumerate(cand):
+    p = bisect.bisect_left(tails, j)
+    if p > 0: back[k] = tops[p-1]
+    if p == len(tails):
+      tails.append(j)
+      tops.append(k)
+    else:
+      tails[p] = j
+      tops[p] = k
+  anchors = []
+  k = tops[-1]
+  while k is not None:
+    anchors.append(cand[k])
+    k = back[k]
+  anchors.reverse()
+  return anchors
+
+def anchored_opcodes(a, b):
+  """ A replacement for SequenceMatcher(None, a, b).get_opcodes() that
+      scales to large documents. Unique words common to both sequences are
+      used as anchors (patience diff). Between the anchors we try again
+      with the words that became unique there, and only the remaining gaps
+      without any anchors are handed to SequenceMatcher. Those gaps are
+      usually tiny, so the overall runtime is close to linear.
+  """
+  blocks = []
+  todo = [(0, len(a), 0, len(b))]
+  while todo:
+    # common head and tail are cheap, and often most of the text.
+    alo, ahi, blo, bhi = strip_common(a, b, *todo.pop(), blocks=blocks)
+    if alo == ahi or blo == bhi:
+      continue
+
+    anchors = unique_anchors(a, b, alo, ahi, blo, bhi)
+    if not anchors:
+      sm = SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+      for i, j, n in sm.get_matching_blocks():
+        blocks.append((alo+i, blo+j, n))
+      continue
+    for i, j in anchors:
+      blocks.append((i, j, 1))
+      todo.append((alo, i, blo, j))
+      alo, blo = i+1, j+1
+    todo.append((alo, ahi, blo, bhi))
+  blocks.sort()
+  return blocks2opcodes(blocks, len(a), len(b))
+
+def line_word_opcodes(ids_old, ids_new, wl_old, wl_new, algorithm='difflib', jobs=1):
+  """ two level diff: first compare entire lines (see wordlist_lines()), then
+      diff words only inside runs of replaced lines. Inserted or deleted
+      lines need no word diff at all. With jobs > 1, the word diffs run in
+      parallel. Returns opcodes in word coordinates.
+  """
+  st_old = wordlist_lines(wl_old)
+  st_new = wordlist_lines(wl_new)
+  table = {}
+  l_old = intern_ranges(ids_old, st_old, table)
+  l_new = intern_ranges(ids_new, st_new, table)
+  table = None
+  blocks = []
+  replaced = []
+  for tag, i1, i2, j1, j2 in diff_algorithms[algorithm](l_old, l_new):
+    i1, i2, j1, j2 = st_old[i1], st_old[i2], st_new[j1], st_new[j2]
+    if tag == 'equal':
+      blocks.append((i1, j1, i2-i1))
+    elif tag == 'replace':
+      replaced.append((i1, i2, j1, j2))
+  print(" ... %d lines, %d changed runs, %d words to diff" % (len(l_old)+len(l_new), len(replaced),
+        sum([o2-o1+n2-n1 for o1, o2, n1, n2 in replaced])))
+  results = map_jobs(diff_job, [(algorithm, ids_old[o1:o2], ids_new[n1:n2])
+                                for o1, o2, n1, n2 in replaced], jobs)
+  for (i1, i2, j1, j2), opcodes in zip(replaced, results):
+    for tag, a1, a2, b1, b2 in opcodes:
+      if tag == 'equal': blocks.append((i1+a1, j1+b1, a2-a1))
+  blocks.sort()
+  return blocks2opcodes(blocks, len(ids_old), len(ids_new))
+
+def edit_distance_exceeds(a, b, max_cost):
+  """ returns True, if more than max_cost elements must be inserted or
+      deleted to turn a into b. This is the greedy forward part of Myers'
+      algorithm, it stops after max_cost steps. Runtime is thus bounded by
+      O((len(a)+len(b))*max_cost), no matter how different a and b are.
+  """
+  alo, ahi, blo, bhi = strip_common(a, b, 0, len(a), 0, len(b), [])
+  N = ahi-alo
+  M = bhi-blo
+  if N+M <= max_cost: return False
+  if abs(N-M) > max_cost: return True
+  off = max_cost+1
+  v = [0] * (2*off+1)
+  for d in range(0, max_cost+1):
+    for k in range(-d, d+1, 2):
+      if k == -d or (k != d and v[off+k-1] < v[off+k+1]):
+        x = v[off+k+1]
+      else:
+        x = v[off+k-1]+1
+      y = x-k
+      while x < N and y < M and a[alo+x] == b[blo+y]:
+        x += 1
+        y += 1
+      v[off+k] = x
+      if x >= N and y >= M: return False
+  return True
+
+def coarse_opcodes(ids_old, ids_new, wl_old, wl_new, max_cost):
+  """ a cheap substitute for the word diff, when edit_distance_exceeds().
+      Entire lines are compared, if that also costs more than max_cost,
+      entire pages are compared. Either way, the runtime is bounded.
+      Returns opcodes in word coordinates, where all words of
+      differing lines (or pages) are replaced, inserted or deleted.
+  """
+  for unit, starts in (('line', wordlist_lines), ('page', wordlist_pages)):
+    st_old = starts(wl_old)
+    st_new = starts(wl_new)
+    table = {}
+    u_old = intern_ranges(ids_old, st_old, table)
+    u_new = intern_ranges(ids_new, st_new, table)
+    if unit == 'line':
+      if edit_distance_exceeds(u_old, u_new, max_cost):
+        print(" ... more than %d changed lines" % max_cost)
+        continue
+      opcodes = myers_opcodes(u_old, u_new)
+    else:
+      # there are few pages, even difflib is fast here.
+      opcodes = difflib_opcodes(u_old, u_new)
+    print(" ... %s diff of %d %ss" % (unit, len(u_old)+len(u_new), unit))
+    blocks = [(st_old[i1], st_new[j1], st_old[i2]-st_old[i1])
+              for tag, i1, i2, j1, j2 in opcodes if tag == 'equal']
+    return blocks2opcodes(blocks, len(ids_old), len(ids_new))
+
+def moved_block_pairs(ids_old, ids_new, deletes, inserts, similarity):
+  """ deletes is a list of (i1, i2) ranges in ids_old, inserts is a list of
+      (j1, j2) ranges in ids_new. Returns a sorted list of (ins_idx, del_idx, r),
+      for all pairs where SequenceMatcher(None, ins, del).ratio() is r >= similarity.
+
+      Instead of trying every pair, we index all blocks by their rarest words.
+      The ratio is 2*M/(l_ins+l_del), and M cannot exceed the number of words
+      that both blocks have in common. Thus a block of length l can only match
+      blocks that share at least similarity*l/(2-similarity) words with it, and
+      at least one of those must be among its l-that+1 rarest words
+      (prefix filtering). Only pairs sharing such a word get the exact ratio check.
+  """
+  if similarity <= 0.0:
+    cand = [(k, n) for k in range(len(inserts)) for n in range(len(deletes))]
+  else:
+    # a word that occurs several times in a block is indexed as (word, 1), (word, 2), ...
+    # so that set intersections count like multiset intersections.
+    def elements(seq, lo, hi):
+      seen = {}
+      r = []
+      for w in seq[lo:hi]:
+        c = seen.get(w, 0)
+        seen[w] = c+1
+        r.append((w, c))
+      return r
+    el_del = [elements(ids_old, i1, i2) for i1, i2 in deletes]
+    el_ins = [elements(ids_new, j1, j2) for j1, j2 in inserts]
+    freq = {}
+    for els in el_del + el_ins:
+      for e in els: freq[e] = freq.get(e, 0) + 1
+
+    def prefix(els):
+      els.sort(key=lambda e: (freq[e], e))
+      overlap = int(math.ceil(similarity*len(els)/(2.0-similarity) - 1e-9))
+      return els[:len(els)-max(overlap, 1)+1]
+
+    index = {}
+    for n, els in enumerate(el_del):
+      for e in prefix(els): index.setdefault(e, []).append(n)
+    cand = set()
+    for k, els in enumerate(el_ins):
+      for e in prefix(els):
+        for n in index.get(e, ()): cand.add((k, n))
+    cand = sorted(cand)
+
+  pairs = []
+  for k, n in cand:
+    j1, j2 = inserts[k]
+    i1, i2 = deletes[n]
+    if 2.0*min(j2-j1, i2-i1)/(j2-j1+i2-i1) < similarity: continue
+    ## could also use levenshtein() to compute a distance.
+    sm = SequenceMatcher(None, ids_new[j1:j2], ids_old[i1:i2], autojunk=False)
+    if sm.quick_ratio() < similarity: continue
+    r = sm.ratio()
+    if r >= similarity:
+      pairs.append((k, n, r))
+  return pairs
+
+# All diff backends take two sequences and return a list of
+# (tag, i1, i2, j1, j2) opcodes, just like SequenceMatcher.get_opcodes().
+diff_algorithms = { 'difflib':   difflib_opcodes,
+                    'myers':     myers_opcodes,
+                    'patience':  anchored_opcodes,
+                    'histogram': histogram_opcodes }
+
+def diff_job(job):
+  """ job is a tuple (algorithm, a, b). Runs in a worker process of map_jobs(). """
+  algorithm, a, b = job
+  return diff_algorithms[algorithm](a, b)
+
+def map_jobs(func, job_list, jobs=1):
+  """ returns [func(job) for job in job_list], computed by a pool of jobs
+      worker processes, if jobs > 1. The result order is always the order of job_list.
+      func must be a module level function, so that it can be pickled.
+  """
+  if jobs is None or jobs <= 1 or len(job_list) < 2:
+    return [func(job) for job in job_list]
+  pool = multiprocessing.Pool(min(jobs, len(job_list)))
+  try:
+    return pool.map(func, job_list, chunksize=max(1, len(job_list)//(4*jobs)))
+  finally:
+    pool.close()
+    pool.join()
+
+def segmented_opcodes(a, b, algorithm='difflib', jobs=1, segment_words=5000):
+  """ splits a and b at unique common words (see unique_anchors()) into
+      segments of about segment_words words, and diffs all segments
+      independently with the given algorithm, using map_jobs().
+      The returned opcodes are in the coordinates of a and b, as usual.
+      The segmentation does not depend on jobs, thus the result does not either.
+      It may differ from a single diff over a and b near segment boundaries.
+  """
+  blocks = []
+  segments = []
+  alo, ahi, blo, bhi = strip_common(a, b, 0, len(a), 0, len(b), blocks)
+  if alo < ahi and blo < bhi:
+    for i, j in unique_anchors(a, b, alo, ahi, blo, bhi):
+      if (i-alo) + (j-blo) >= segment_words:
+        segments.append((alo, i, blo, j))
+        blocks.append((i, j, 1))
+        alo, blo = i+1, j+1
+    segments.append((alo, ahi, blo, bhi))
+  print(" ... %d segments" % len(segments))
+  results = map_jobs(diff_job, [(algorithm, a[s1:s2], b[t1:t2])
+                                for s1, s2, t1, t2 in segments], jobs)
+  for (alo, ahi, blo, bhi), opcodes in zip(segments, results):
+    for tag, i1, i2, j1, j2 in opcodes:
+      if tag == 'equal': blocks.append((alo+i1, blo+j1, i2-i1))
+  blocks.sort()
+  return blocks2opcodes(blocks, len(a), len(b))
+
+def pdfhtml_xml_find(pages, re_pattern=None, wordlist=None, nocase=False, ext={}, first_page=None, last_page=None, mark_ops="D,A,C", margins=None, strict=False, spell_check=False, move_similarity=0.95, move_minwords=10, diff_algorithm='difflib', jobs=1, max_diff_cost=None, line_diff=False, segment_words=None):
+  """traverse the pages, (which are expected to come from pdf2xml())
      find all occurances of re_pattern on all pages, returning rect list for 
      each page, giving the exact coordinates of the bounding box of all 
      occurances. Font metrics are used to interpolate into the line fragments 
-     found in the dom tree.
+     found in the pages.
      Keys and values from ext['e'] are merged into the DecoratedWord output for pattern matches and spell check findings.
      If re_pattern is None, then wordlist is used instead. 
      Keys and values from ext['a'], ext['d'], or ext['c'] respectively are merged into 
      the DecoratedWord output for added, deleted, or changed texts (respectivly).
      mark_ops defines which diff operations are marked.
+     diff_algorithm names one of the diff_algorithms backends, which
+     is used for the word diff and for the second level diff of moved blocks.
+     If segment_words is given, the word diff is split into segments of about
+     that many words by segmented_opcodes().
+     With jobs > 1, a pool of worker processes is used: segments and second level
+     diffs run in parallel. jobs changes only the speed, never the result.
+     If more than max_diff_cost words were inserted or deleted, the word diff is
+     skipped in favour of coarse_opcodes(), which marks entire lines or pages.
+     If line_diff is True, line_word_opcodes() compares entire lines first.
   """
 
   ######
@@ -1145,7 +2550,7 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
       l = 0 
 
     mark = create_mark(w[1], off, l,
-          fontinfo[p_nr][w[3]['f']]['font'], 
+          fontinfo[w[3]['f']]['font'], 
           w[3]['x'],w[3]['y'],w[3]['w'],w[3]['h'], attr)
     if not p_nr in r_dict: r_dict[p_nr] = []
     r_dict[p_nr].append(mark)
@@ -1203,7 +2608,7 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
     return [text, page_or_elem+loc_or_lineno]
   ######
 
-  fontinfo = xml2fontinfo(dom, last_page)
+  fontinfo = xml2fontinfo(pages, last_page)
 
   ops = {}
   for op in mark_ops.split(','):
@@ -1212,10 +2617,16 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
   p_rect_dict = {}   # indexed by page numbers, then lists of marks
   if wordlist or spell_check:
     # generate our wordlist too, so that we can diff against the given wordlist or spell_check.
-    wl_new = xml2wordlist(dom, first_page, last_page, margins=margins)
+    wl_new = xml2wordlist(pages, first_page, last_page, margins=margins)
   if wordlist:
-    s = SequenceMatcher(None, wordlist, wl_new, autojunk=False)
-    # print("SequenceMatcher done")     # this means nothing... s.get_opcodes() takes ages!
+    diff_opcodes = diff_algorithms[diff_algorithm]
+    # the diff only sees word numbers. The DecoratedWords are consulted
+    # when we produce marks.
+    word_ids = {}
+    ids_old = intern_wordlist(wordlist, word_ids)
+    ids_new = intern_wordlist(wl_new, word_ids)
+    print("%d words, %d distinct" % (len(ids_old)+len(ids_new), len(word_ids)))
+    word_ids = None
 
     def opcodes_find_moved(iter_list):
       """ adds a 6th element to the yielded tuple, which holds refernces between 
@@ -1237,21 +2648,18 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
         all = []
         for tag, i1, i2, j1, j2 in iter_list:
           all.append((tag, i1, i2, j1, j2, {}))
-        for tag, i1, i2, j1, j2, hint in all:
-          for tagb, i1b, i2b, j1b, j2b, hintb in all:
-            if (tag == 'insert' and tagb == 'delete' and 
-                (i2b-i1b) > move_minwords and 
-                (j2 - j1) > move_minwords):
-              list_ins = wl_new[j1:j2]
-              list_del = wordlist[i1b:i2b]
-              ## could also use levenshtein() to compute a distance.
-              sm = SequenceMatcher(None, list_ins, list_del, autojunk=False)
-              r = sm.ratio()
-              if r >= move_similarity:
-                if not 'ref' in hint:  hint['ref'] = []
-                if not 'ref' in hintb: hintb['ref'] = []
-                hint['ref'].append((r, i1b, i2b))   # wordlist[..]
-                hintb['ref'].append((r, j1, j2))    # wl_new[..]
+        ins = [x for x in all if x[0] == 'insert' and (x[4]-x[3]) > move_minwords]
+        dels = [x for x in all if x[0] == 'delete' and (x[2]-x[1]) > move_minwords]
+        print(" ... %d inserts, %d deletes ..." % (len(ins), len(dels)))
+        for k, n, r in moved_block_pairs(ids_old, ids_new,
+                                         [(x[1], x[2]) for x in dels],
+                                         [(x[3], x[4]) for x in ins], move_similarity):
+          tag, i1, i2, j1, j2, hint = ins[k]
+          tagb, i1b, i2b, j1b, j2b, hintb = dels[n]
+          if not 'ref' in hint:  hint['ref'] = []
+          if not 'ref' in hintb: hintb['ref'] = []
+          hint['ref'].append((r, i1b, i2b))   # wordlist[..]
+          hintb['ref'].append((r, j1, j2))    # wl_new[..]
       
         print(" ... sorting ...")
       
@@ -1262,17 +2670,23 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
               print('moved:', tag, i1, i2, j1, j2, hint)   # , catwords_raw(wl_new, j1, j2)
       
         print(" ... moving ...")
+
+        # second level diff ahead:
+        # hint tells us where the other wordlist is.
+        # These diffs are independent of each other, they can run in parallel.
+        moved = [x for x in all if x[0] == "insert" and len(x[5].get('ref',[])) > 0]
+        moved_opcodes = map_jobs(diff_job, [(diff_algorithm,
+                                             ids_old[x[5]['ref'][0][1]:x[5]['ref'][0][2]],
+                                             ids_new[x[3]:x[4]]) for x in moved], jobs)
+        moved_opcodes.reverse()
       
         for tag, i1, i2, j1, j2, hint in all:
           if (tag == "insert" and len(hint.get('ref',[])) > 0):
-            # second level diff ahead:
-            # hint tells us where the other wordlist is
             i1b = hint['ref'][0][1]
             i2b = hint['ref'][0][2]
             # print ["add new", catwords(wl_new, j1, j2)]
             # print ["add ref", catwords(wordlist, i1b, i2b)]
-            sm_2 = SequenceMatcher(None, wordlist[i1b:i2b], wl_new[j1:j2], autojunk=False)
-            for tag_2, i1_2, i2_2, j1_2, j2_2 in sm_2.get_opcodes():
+            for tag_2, i1_2, i2_2, j1_2, j2_2 in moved_opcodes.pop():
               if tag_2 == "equal": 
                 tag_2 = "move"
               if tag_2 == "delete": hint = {}
@@ -1339,8 +2753,18 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
         yield (tag, i1,i2, j1,j2, hint)
 
 
-    print("SequenceMatcher get_opcodes()")
-    for tag, i1, i2, j1, j2, hint in opcodes_post_proc(s.get_opcodes()):
+    # with difflib, this is the part that takes ages.
+    print("%s diff ..." % diff_algorithm)
+    if max_diff_cost is not None and edit_distance_exceeds(ids_old, ids_new, max_diff_cost):
+      print(" ... more than %d words changed, marking entire lines" % max_diff_cost)
+      opcodes = coarse_opcodes(ids_old, ids_new, wordlist, wl_new, max_diff_cost)
+    elif line_diff:
+      opcodes = line_word_opcodes(ids_old, ids_new, wordlist, wl_new, diff_algorithm, jobs)
+    elif segment_words:
+      opcodes = segmented_opcodes(ids_old, ids_new, diff_algorithm, jobs, segment_words)
+    else:
+      opcodes = diff_opcodes(ids_old, ids_new)
+    for tag, i1, i2, j1, j2, hint in opcodes_post_proc(opcodes):
       if tag == "equal":
         if 'e' in ops:
           attr = ext['e'].copy()
@@ -1380,7 +2804,7 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
         else:
           continue
       else:
-        print("SequenceMatcher returned unknown tag: %s" % tag)
+        print("%s diff returned unknown tag: %s" % (diff_algorithm, tag))
         continue
       # print("len(wl_new)=%d, j in [%d:%d] %s" % (len(wl_new), j1, j2,tag))
       for j in range(j1,j2):
@@ -1426,49 +2850,47 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
   # next loop through all pages, select the correct p_rect from the dict.
   # Start or continue adding re_pattern search results while if any.
   # Finally collect all in pages_a.in pages_a.
+  if first_page is None: first_page = 0
+  if re_pattern:
+    flags = re.UNICODE | re.MULTILINE   # ^ and $ still match at the start and end of each run
+    if (nocase): flags |= re.IGNORECASE
+    re_search = re.compile(re_pattern, flags)
   pages_a = []
-  p_nr = 0
-  for p in dom.findall('page'):
+  for p in pages:
     if not last_page is None:
-      if p_nr > int(last_page):
+      if p.nr > int(last_page)+1:
         break
-    p_nr += 1
+    if p.nr <= int(first_page):
+      continue
+    p_nr = p.nr
 
     p_rect = p_rect_dict.get(p_nr,[])
     if re_pattern:
-      for e in p.findall('text'):
-        p_finfo = fontinfo[p_nr]
-        text = ''
-        for t in e.itertext(): text += t
-        if not strict:
-          text = zap_letter_spacing(text)
-  
-        #pprint([e.attrib, text])
-        #print("search (%s)" % re_pattern)
-        flags = re.UNICODE
-        if (nocase): flags |= re.IGNORECASE
-        # l = map(lambda x:len(x), re.split('('+re_pattern+')', text, flags=flags))
-        l = [len(x) for x in re.split('('+re_pattern+')', text, flags=flags)]
-        l.append(0)       # dummy to make an even number.
-        # all odd indices in l are word lengths, all even ones are seperator lengths
-        offset = 0
-        i = 0
-        while (i < len(l)):
-          # print("offset=%d, i=%d, l=%s" % (offset, i, repr(l)))
-          offset += l[i]
-          if (l[i+1] > 0):
-  
-            p_rect.append(create_mark(text,offset,l[i+1], 
-              p_finfo[e.attrib['font']]['font'], 
-              e.attrib['left'], e.attrib['top'], 
-              e.attrib['width'],e.attrib['height'], ext['e']))
-    
-            offset += l[i+1]
-          i += 2
-    pages_a.append({'nr':int(p.attrib['number']), 'rect':p_rect, 
+      # All texts of the page are searched in one pass: joined with newlines,
+      # as in page2wordlist(). A match that spans several runs is marked in each
+      # of them; empty matches are skipped.
+      texts = [r.text if strict else r.norm for r in p.texts]
+      page_text = "\n".join(texts)
+      #print("search (%s)" % re_pattern)
+      spans = [f.span() for f in re_search.finditer(page_text) if f.end() > f.start()]
+      lo = 0
+      start = 0                 # of run r in page_text
+      for r, text in zip(p.texts, texts):
+        end = start + len(text)
+        while lo < len(spans) and spans[lo][1] <= start:
+          lo += 1
+        hi = lo
+        while hi < len(spans) and spans[hi][0] < end:
+          offset = max(spans[hi][0], start) - start
+          length = min(spans[hi][1], end) - start - offset
+          if length > 0:
+            p_rect.append(create_mark(text,offset,length, 
+              fontinfo[r['f']]['font'], r['x'], r['y'], r['w'], r['h'], ext['e']))
+          hi += 1
+        start = end + 1
+    pages_a.append({'nr':p.nr, 'rect':p_rect, 
                  'nav_c':ext['e'].get('c',[.5,.5,.5]),
-                 'h':float(p.attrib['height']), 'w':float(p.attrib['width']),
-                 'x':float(p.attrib['left']), 'y':float(p.attrib['top'])})
+                 'h':p.h, 'w':p.w, 'x':p.x, 'y':p.y})
   return pages_a
 
 
@@ -26,3 +26,48 @@ def test_scipy():
          import scipy 
          assert scipy.__version__
 
+
+top = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+def marks(*args):
+         """
+         Runs pdf_highlight.py -n with args, and returns the page number and the
+         text (or tag) of each mark, as written to its -l logfile.
+         Uses --extractor pypdf, so that pdftohtml is not needed.
+         """
+         import sys, subprocess, tempfile, ast
+         log = tempfile.NamedTemporaryFile(suffix='.txt')
+         cmd = [sys.executable, os.path.join(top, 'pdf_highlight.py'), '--extractor', 'pypdf', '-n', '-l', log.name]
+         proc = subprocess.Popen(cmd + list(args), stdout=subprocess.PIPE, cwd=top)
+         proc.communicate()
+         assert proc.returncode in (0, 1)        # 1: there were hits
+         return [(p['nr'], [r['t'] for r in p['rect']]) for p in ast.literal_eval(log.read())]
+
+def test_first_last_page():
+         """
+         Checks, if -F 2 -L 3 processes pages 2 and 3 only.
+         test/pages2.pdf changes one word on pages 1, 3 and 4 of test/pages1.pdf.
+         """
+         assert marks('-F', '2', '-L', '3', '-c', 'test/pages1.pdf', 'test/pages2.pdf') == \
+                  [(2, []), (3, ['chg'])]
+
+def test_search_group():
+         """
+         Checks, if -s marks the entire match of a pattern with groups
+         """
+         assert marks('-s', 'pa(ge) ([0-9])', 'test/pages1.pdf') == \
+                  [(p, ['page %d' % p] * 4) for p in range(1, 5)]
+
+def test_search_across_runs():
+         """
+         Checks, if -s finds matches spanning two text runs, and marks the part in each run
+         """
+         assert marks('-s', 'line 1\s+Hello', 'test/pages1.pdf') == \
+                  [(p, ['line 1', 'Hello']) for p in range(1, 5)]
+
+def test_search_anchored():
+         """
+         Checks, if ^ and $ match at the start and end of each text run
+         """
+         assert marks('-s', '^Hello', 'test/pages1.pdf') == [(p, ['Hello'] * 4) for p in range(1, 5)]
+         assert marks('-s', 'line [34]$', 'test/pages1.pdf') == [(p, ['line 3', 'line 4']) for p in range(1, 5)]
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Checks all word diff backends of pdf_highlight.diff_algorithms:
+# they must return valid get_opcodes() lists, and myers must be minimal.
+
+import os, sys, random, subprocess
+
+top = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, top)
+import pdf_highlight
+
+
+def random_pair(rnd):
+         """
+         a random word sequence, and a copy with some words inserted, deleted or replaced.
+         Small alphabets give many repeated words, as in real documents.
+         """
+         alphabet = rnd.choice([3, 10, 50])
+         a = [rnd.randrange(alphabet) for i in range(rnd.randrange(60))]
+         b = list(a)
+         for k in range(rnd.randrange(8)):
+                  i = rnd.randrange(len(b)+1)
+                  b[i:i+rnd.randrange(4)] = [rnd.randrange(alphabet+5) for x in range(rnd.randrange(4))]
+         return a, b
+
+def pairs(n=300):
+         rnd = random.Random(42)
+         yield [], []
+         yield [1, 2, 3], []
+         yield [], [1, 2, 3]
+         yield [1, 2, 3], [1, 2, 3]
+         yield [1, 2, 3], [4, 5, 6]
+         for k in range(n):
+                  yield random_pair(rnd)
+
+def check_opcodes(a, b, opcodes):
+         """
+         opcodes must be contiguous, cover both sequences and be valid.
+         """
+         i = j = 0
+         for tag, i1, i2, j1, j2 in opcodes:
+                  assert (i1, j1) == (i, j)
+                  assert i1 <= i2 and j1 <= j2
+                  if tag == 'equal':
+                           assert a[i1:i2] == b[j1:j2] and i2 > i1
+                  elif tag == 'delete':
+                           assert i2 > i1 and j2 == j1
+                  elif tag == 'insert':
+                           assert i2 == i1 and j2 > j1
+                  elif tag == 'replace':
+                           assert i2 > i1 and j2 > j1
+                  else:
+                           assert False, tag
+                  i, j = i2, j2
+         assert (i, j) == (len(a), len(b))
+
+def lcs_length(a, b):
+         row = [0] * (len(b)+1)
+         for x in a:
+                  prev = 0
+                  for j, y in enumerate(b):
+                           cur = row[j+1]
+                           row[j+1] = prev + 1 if x == y else max(row[j+1], row[j])
+                           prev = cur
+         return row[-1]
+
+def test_valid_opcodes():
+         """
+         Checks, if every backend returns valid opcodes covering both sequences
+         """
+         for name, algorithm in sorted(pdf_highlight.diff_algorithms.items()):
+                  for a, b in pairs():
+                           check_opcodes(a, b, algorithm(a, b))
+
+def test_myers_minimal():
+         """
+         Checks, if myers finds a longest common subsequence
+         """
+         for a, b in pairs():
+                  opcodes = pdf_highlight.myers_opcodes(a, b)
+                  equal = sum([i2-i1 for tag, i1, i2, j1, j2 in opcodes if tag == 'equal'])
+                  assert equal == lcs_length(a, b)
+
+def test_segmented_opcodes():
+         """
+         Checks, if segmented diffs are valid, and independent of the number of jobs
+         """
+         for a, b in pairs(50):
+                  opcodes = pdf_highlight.segmented_opcodes(a, b, 'myers', 1, 10)
+                  check_opcodes(a, b, opcodes)
+                  assert opcodes == pdf_highlight.segmented_opcodes(a, b, 'myers', 2, 10)
+
+def test_cli_diff_algorithm():
+         """
+         Checks, if each --diff-algorithm marks test1.pdf against test2.pdf like the default.
+         Uses --extractor pypdf, so that pdftohtml is not needed.
+         """
+         def hits(*opts):
+                  cmd = [sys.executable, os.path.join(top, 'pdf_highlight.py'), '--extractor', 'pypdf', '-n']
+                  cmd += list(opts) + ['-c', os.path.join(top, 'test', 'test1.pdf'), os.path.join(top, 'test', 'test2.pdf')]
+                  proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+                  out = proc.communicate()[0]
+                  assert proc.returncode in (0, 1)        # 1: there were differences
+                  return [l for l in out.split("\n") if l.startswith(' page ')]
+         default = hits()
+         assert len(default)
+         for name in sorted(pdf_highlight.diff_algorithms.keys()):
+                  assert hits('--diff-algorithm', name) == default
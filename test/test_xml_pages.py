@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Checks parsing of pdftohtml -xml output with xml_pages() and AnchorFilter.
+
+import os, sys, re, random
+from StringIO import StringIO
+
+top = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, top)
+import pdf_highlight
+
+
+# pdftohtml -xml misplaces the closing </a>, this is invalid xml.
+broken = '''<?xml version="1.0" encoding="UTF-8"?>
+<pdf2xml>
+<page number="1" position="absolute" top="0" left="0" height="1188" width="918">
+	<fontspec id="0" size="14" family="Times" color="#000000"/>
+<text top="100" left="50" width="300" height="15" font="0"><i>Scanning Issue<a href="http://support.novell.com/">s</i>and</a> more</text>
+<text top="120" left="50" width="300" height="15" font="0">see <a href="#2">page 2</a> and <a href="http://example.com/?a=1&amp;b=2">this</a></text>
+</page>
+<page number="2" position="absolute" top="0" left="0" height="1188" width="918">
+<text top="100" left="50" width="300" height="15" font="0"><b>Page <a href="#1">one</a></b> again</text>
+</page>
+</pdf2xml>
+'''
+
+class ChunkedReader(object):
+         """
+         a file object returning at most a few bytes per read, so that tags cross reads.
+         """
+         def __init__(self, data, seed):
+                  self.data = data
+                  self.rnd = random.Random(seed)
+
+         def read(self, size=-1):
+                  n = self.rnd.randrange(1, 8)
+                  if size >= 0: n = min(n, size)
+                  data, self.data = self.data[:n], self.data[n:]
+                  return data
+
+def read_all(f):
+         out = ''
+         while True:
+                  data = f.read(4096)
+                  if not len(data): return out
+                  out += data
+
+def texts(pages):
+         return [(p.nr, [r.text for r in p.texts]) for p in pages]
+
+def test_anchor_filter_split_tags():
+         """
+         Checks, if <a ...> and </a> tags are removed, also when split across reads
+         """
+         expected = re.sub("(<a.*?>|</a>)", "", broken)
+         assert not '<a' in expected and not '</a>' in expected
+         assert read_all(pdf_highlight.AnchorFilter(StringIO(broken))) == expected
+         for seed in range(200):
+                  f = pdf_highlight.AnchorFilter(ChunkedReader(broken, seed))
+                  assert read_all(f) == expected
+
+def test_xml_pages_broken_anchors():
+         """
+         Checks, if misplaced anchors parse through AnchorFilter, keeping their text
+         """
+         pages = list(pdf_highlight.xml_pages(pdf_highlight.AnchorFilter(ChunkedReader(broken, 1))))
+         assert texts(pages) == [(1, ['Scanning Issuesand more', 'see page 2 and this']),
+                                 (2, ['Page one again'])]
+
+def test_xml_pages_valid_anchors():
+         """
+         Checks, if AnchorFilter changes nothing for valid xml with anchors
+         """
+         valid = broken.replace('s</i>and</a>', 's</a></i>and')
+         plain = list(pdf_highlight.xml_pages(StringIO(valid)))
+         filtered = list(pdf_highlight.xml_pages(pdf_highlight.AnchorFilter(ChunkedReader(valid, 2))))
+         assert texts(plain) == texts(filtered)